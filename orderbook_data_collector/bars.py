@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental OHLCV and trade-flow bars.
+
+Bars are updated in O(1) per trade at every resolution, and handed out once
+they close: when a trade of a later interval arrives, or when close_expired()
+is called after the end of the interval. Intervals without trades produce no
+bar. A trade without a timestamp can't be put in an interval and is left out.
+
+@author: zhishe
+"""
+
+import datetime
+
+RESOLUTIONS = (1, 60, 300)  # seconds
+
+
+def trade_time(trade):
+    """
+    The exchange timestamp of a trade, '2020-06-18T19:56:10.123Z', in seconds.
+    None if the trade has none ('' once cleaned by helper_dict_clean).
+    """
+    if not trade.get('timestamp'):
+        return None
+    return datetime.datetime.fromisoformat(trade['timestamp'].replace('Z', '+00:00')).timestamp()
+
+
+class Bar:
+    def __init__(self, resolution, start):
+        self.resolution = resolution
+        self.start = start
+        self.open = None
+        self.high = None
+        self.low = None
+        self.close = None
+        self.volume = 0
+        self.turnover = 0.0  # sum of price * size, for the VWAP
+        self.buyVolume = 0
+        self.sellVolume = 0
+        self.trades = 0
+
+    def add(self, price, size, side):
+        if self.open is None:
+            self.open = self.high = self.low = price
+        else:
+            self.high = max(self.high, price)
+            self.low = min(self.low, price)
+        self.close = price
+        self.volume += size
+        self.turnover += price * size
+        if side == 'Buy':
+            self.buyVolume += size
+        else:
+            self.sellVolume += size
+        self.trades += 1
+
+    def to_dict(self):
+        return {'resolution': self.resolution,
+                'start': self.start,
+                'open': self.open,
+                'high': self.high,
+                'low': self.low,
+                'close': self.close,
+                'volume': self.volume,
+                'vwap': self.turnover / self.volume if self.volume else self.close,
+                'buyVolume': self.buyVolume,
+                'sellVolume': self.sellVolume,
+                'trades': self.trades}
+
+
+class BarAggregator:
+    def __init__(self, resolutions=RESOLUTIONS):
+        """
+        resolutions : tuple of int
+            bar lengths in seconds.
+        """
+        self.resolutions = resolutions
+        self.current = {}  # resolution : open Bar
+        self.closedUntil = {}  # resolution : end of the last bar handed out
+        self.lateTrades = 0  # trades left out because their bar was already handed out
+
+    def add_trades(self, trades):
+        """
+        trades : list of dict
+            rows of the trade table.
+
+        Returns the bars closed by these trades, as dicts, oldest first.
+        """
+        closed = []
+        for trade in trades:
+            t = trade_time(trade)
+            if t is None:
+                continue
+            for resolution in self.resolutions:
+                start = t - t % resolution
+                if start < self.closedUntil.get(resolution, 0):
+                    self.lateTrades += 1  # late trade of a bar already handed out
+                    continue
+                bar = self.current.get(resolution)
+                if bar is not None and bar.start != start:
+                    closed.append(self.__close(bar))
+                    bar = None
+                if bar is None:
+                    bar = self.current[resolution] = Bar(resolution, start)
+                bar.add(trade['price'], trade['size'], trade['side'])
+        return closed
+
+    def close_expired(self, now):
+        """
+        Close the bars whose interval ended before `now`, in seconds. `now` should be
+        exchange time, so that a local clock ahead of the exchange doesn't close bars early.
+        """
+        closed = []
+        for resolution, bar in list(self.current.items()):
+            if bar.start + resolution <= now:
+                closed.append(self.__close(bar))
+        return closed
+
+    def __close(self, bar):
+        del self.current[bar.resolution]
+        self.closedUntil[bar.resolution] = bar.start + bar.resolution
+        return bar.to_dict()
@@ -7,11 +7,14 @@ import json
 import logging
 import urllib
 import math
-from queue import Queue
+import heapq
 from util.api_key import generate_nonce, generate_signature
 
 from orderbook.orderbook import Bid, Ask, OrderBook
+from orderbook.redisOrderTree import levelChecksum, keyPrefix
 from db_writer import write_to_db
+from spill_queue import SpillQueue
+from bars import BarAggregator, trade_time
 
 from bitmex_config import ACCOUNT
 
@@ -19,8 +22,19 @@ DIR = '/Users/zhishe/myProjects/bitmex'
 
 EXCH = 'BitMEX'
 
-# This is what I'm asked to write into Redis
-TARGET = ['orderBookL2', 'margin', 'position']
+# This is what I'm asked to write into Redis, along with the order book table of the profile
+TARGET = ['margin', 'position']
+
+# Subscription profiles.
+# table : the order book table subscribed to
+# depth : None to mirror every orderBookL2 level into Redis as it arrives, otherwise the
+#         number of levels per side derived locally from the table and kept in Redis
+PROFILES = {
+    'full': {'table': 'orderBookL2', 'depth': None},  # all levels
+    'l2_top': {'table': 'orderBookL2', 'depth': 25},  # all levels locally, top 25 in Redis
+    'orderBook10': {'table': 'orderBook10', 'depth': 10},  # top 10 levels, pushed as a whole
+    'quote': {'table': 'quote', 'depth': 1},  # best bid and ask only
+}
 
 
 def setup_logger():
@@ -66,8 +80,27 @@ class BitMEXWebsocket:
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
-    def __init__(self, endpoint, symbol, red, api_key=None, api_secret=None):
-        '''Connect to the websocket and initialize data stores.'''
+    # Compare the checksums of the local and Redis order books this often, in seconds.
+    VERIFY_INTERVAL = 10
+
+    # Number of closed bars per resolution kept in Redis.
+    MAX_BARS = 1000
+    # Seconds to wait after the end of a bar for late trades before closing it.
+    BAR_GRACE = 1
+
+    def __init__(self, endpoint, symbol, red, api_key=None, api_secret=None, db_queue=None, connect=True,
+                 profile='full'):
+        '''
+        Connect to the websocket and initialize data stores.
+
+        profile : name of the subscription profile, see PROFILES. The light profiles save
+            bandwidth and CPU; whatever the profile, the Redis order book has the same layout.
+
+        db_queue : queue to put the messages to be written into MongoDB on. If None, a
+            SpillQueue is created and drained by a database writing thread of our own.
+        connect : if False, don't connect; messages are fed in through process_message().
+            Used by the book process of the multi-process pipeline.
+        '''
         self.logger = setup_logger()
         self.logger.debug("Initializing WebSocket.")
 
@@ -83,33 +116,61 @@ class BitMEXWebsocket:
         self.api_key = api_key
         self.api_secret = api_secret
 
+        self.profile = profile
+        self.book_table = PROFILES[profile]['table']
+        self.depth = PROFILES[profile]['depth']
+        self.targets = TARGET + [self.book_table]
+
         self.data = {}
         self.keys = {}
         self.exited = False
 
+        # the levels currently in the Redis order book when it's derived locally,
+        # side -> {price: (orderId, size)}
+        self.levels = {'bid': {}, 'ask': {}}
+
+        # checksums of the local orderBookL2 table by side, see levelChecksum
+        self.checksum = {'bid': 0, 'ask': 0}
+        self.next_verify = time.time() + BitMEXWebsocket.VERIFY_INTERVAL
+
         # Redis
         # instantiate an orderbook in Redis
         self.orderbook = OrderBook(EXCH, symbol, red)
 
+        # all keys of the symbol share a prefix, a hash tag on a Redis Cluster
+        prefix = keyPrefix(EXCH, symbol, red)
         # the key in Redis for margin info
-        self.KEY_TEMPLATE_MARGIN = '%s-%s-margin-%s' % (EXCH, symbol, ACCOUNT)
+        self.KEY_TEMPLATE_MARGIN = '%s-margin-%s' % (prefix, ACCOUNT)
         # the key in Redis for position info
-        self.KEY_TEMPLATE_POSITION = '%s-%s-position-%s' % (EXCH, symbol, ACCOUNT)
+        self.KEY_TEMPLATE_POSITION = '%s-position-%s' % (prefix, ACCOUNT)
+        # the key in Redis for the closed bars of a resolution, a list of JSON, oldest first
+        self.KEY_TEMPLATE_BARS = '%s-bars-%%s' % prefix  # resolution in seconds
 
-        # MongoDB
-        # the collection names to use in MongoDB
-        collection_names = {'margin': self.KEY_TEMPLATE_MARGIN,
-                            'position': self.KEY_TEMPLATE_POSITION,
-                            'orderBookL2': '%s-%s-orderBookL2' % (EXCH, symbol)}
+        # OHLCV bars built from the trades as they arrive
+        self.bars = BarAggregator()
+        # the latest exchange timestamp seen in a message, in seconds; bars are closed by it
+        self.exchange_time = 0
 
-        # start the database writing thread
-        self.db_queue = Queue()
-        self.dbt = threading.Thread(target=write_to_db, args=(collection_names, self.db_queue))
-        self.dbt.start()
+        # MongoDB
+        if db_queue is not None:
+            self.db_queue = db_queue
+            self.dbt = None
+        else:
+            # start the database writing thread
+            # the queue holds a bounded number of messages in memory and spills the rest to
+            # local disk, so a stalled MongoDB neither blocks the websocket thread nor loses data
+            self.db_queue = SpillQueue('%s/spool/%s-%s' % (DIR, EXCH, symbol))
+            self.db_stop = threading.Event()
+            self.dbt = threading.Thread(target=write_to_db,
+                                        args=(get_collection_names(symbol), self.db_queue, self.db_stop))
+            self.dbt.start()
+
+        if not connect:
+            return
 
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
-        wsURL = self.__get_url()
+        wsURL = get_url(self.endpoint, self.symbol, profile)
         self.logger.info("Connecting to %s" % wsURL)
         self.__connect(wsURL, symbol)
         self.logger.info('Connected to WS.')
@@ -123,8 +184,13 @@ class BitMEXWebsocket:
     def exit(self):
         '''Call this to exit - will close websocket.'''
         self.exited = True
-        self.ws.close()
-        self.db_queue.put((datetime.datetime.utcnow().timestamp(), {'action': 'terminate'}))
+        if hasattr(self, 'ws'):
+            self.ws.close()
+        if self.dbt is not None:
+            # the writer stops after the message at hand, the rest stays in the spill queue
+            self.db_stop.set()
+        else:
+            self.db_queue.put((datetime.datetime.utcnow().timestamp(), {'action': 'terminate'}))
 
     def get_instrument(self):
         '''Get the raw instrument data for this symbol.'''
@@ -157,8 +223,8 @@ class BitMEXWebsocket:
         return self.red.hgetall(self.KEY_TEMPLATE_POSITION)
 
     def market_depth(self):
-        '''Get market depth (orderbook). Returns all levels.'''
-        return self.data['orderBookL2']
+        '''Get market depth (orderbook). Returns all levels of the profile's order book table.'''
+        return self.data[self.book_table]
 
     def open_orders(self, clOrdIDPrefix):
         '''Get all your open orders.'''
@@ -170,6 +236,10 @@ class BitMEXWebsocket:
         '''Get recent trades.'''
         return self.data['trade']
 
+    def recent_bars(self, resolution, count=100):
+        '''Get the last closed OHLCV bars of a resolution in seconds, see bars.RESOLUTIONS.'''
+        return [json.loads(bar) for bar in self.red.lrange(self.KEY_TEMPLATE_BARS % resolution, -count, -1)]
+
     #
     # End Public Methods
     #
@@ -204,40 +274,14 @@ class BitMEXWebsocket:
         '''Return auth headers. Will use API Keys if present in settings.'''
         if self.api_key:
             self.logger.info("Authenticating with API Key.")
-            # To auth to the WS using an API key, we generate a signature of a nonce and
-            # the WS API endpoint.
-            expires = generate_nonce()
-            return [
-                "api-expires: " + str(expires),
-                "api-signature: " + generate_signature(self.api_secret, 'GET', '/realtime', expires, ''),
-                "api-key:" + self.api_key
-            ]
         else:
             self.logger.info("Not authenticating.")
-            return []
-
-    def __get_url(self):
-        '''
-        Generate a connection URL. We can define subscriptions right in the querystring.
-        Most subscription topics are scoped by the symbol we're listening to.
-        '''
-
-        # You can sub to orderBookL2 for all levels, or orderBook10 for top 10 levels & save bandwidth
-        symbolSubs = ["execution", "instrument", "order", "orderBookL2", "position", "quote", "trade"]
-        genericSubs = ["margin"]
-
-        subscriptions = [sub + ':' + self.symbol for sub in symbolSubs]
-        subscriptions += genericSubs
-
-        urlParts = list(urllib.parse.urlparse(self.endpoint))
-        urlParts[0] = urlParts[0].replace('http', 'ws')
-        urlParts[2] = "/realtime?subscribe={}".format(','.join(subscriptions))
-        return urllib.parse.urlunparse(urlParts)
+        return get_auth(self.api_key, self.api_secret)
 
     def __wait_for_account(self):
         '''On subscribe, this data will come down. Wait for it.'''
         # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order', 'orderBookL2'} <= set(self.data):
+        while not {'margin', 'position', 'order', self.book_table} <= set(self.data):
             time.sleep(0.1)
 
     def __wait_for_symbol(self, symbol):
@@ -253,6 +297,10 @@ class BitMEXWebsocket:
 
     def __on_message(self, message):
         '''Handler for parsing WS messages.'''
+        self.process_message(message)
+
+    def process_message(self, message):
+        '''Parse a raw WS message and apply it to the data stores.'''
         message = json.loads(message, object_pairs_hook=helper_dict_clean)  # convert None to empty string ''
         self.logger.debug(json.dumps(message))
 
@@ -288,15 +336,24 @@ class BitMEXWebsocket:
                     # an item. We use it for updates.
                     self.keys[table] = message['keys']
 
+                    if table == 'orderBookL2' and self.depth is None:
+                        # start from an empty book, there may be one left over from before a reconnect.
+                        # Also for an empty partial, or the old book would stay in Redis for good.
+                        self.orderbook.bids.clear()
+                        self.orderbook.asks.clear()
+                        self.checksum = {'bid': 0, 'ask': 0}
+
                     # write snapshots into Redis
-                    if table in TARGET and message['data']:  # non-empty message['data']
+                    if table in self.targets and message['data']:  # non-empty message['data']
                         if table == 'margin':
                             # write margin info into Redis using hash
                             self.red.hset(self.KEY_TEMPLATE_MARGIN, mapping=message['data'][0])
                         elif table == 'position':
                             # write position info into Redis using hash
                             self.red.hset(self.KEY_TEMPLATE_POSITION, mapping=message['data'][0])
-                        elif table == 'orderBookL2':
+                        elif table == 'orderBookL2' and self.depth is None:
+                            self.__add_checksum(message['data'], 1)
+
                             # I think timestamp should be included in message,
                             # however it's not, so here I manually create one.
                             timestamp = self.orderbook.getTimestamp()
@@ -326,19 +383,21 @@ class BitMEXWebsocket:
                         self.data[table] = self.data[table][BitMEXWebsocket.MAX_TABLE_LEN // 2:]
 
                     # insert new orders into the orderbook in Redis
-                    if table == 'orderBookL2' and message['data']:
-                        timestamp = self.orderbook.getTimestamp()
-                        buy_orders = []
-                        sell_orders = []
-                        for order in message['data']:
-                            if order['size'] == 'Buy':
-                                buy_orders.append(order)
-                            else:
-                                sell_orders.append(order)
-                        buy_orders = list(map(lambda x: Bid(x['id'], x['size'], x['price'], timestamp), buy_orders))
-                        sell_orders = list(map(lambda x: Ask(x['id'], x['size'], x['price'], timestamp), sell_orders))
-                        self.orderbook.bids.insertManyOrders(buy_orders)
-                        self.orderbook.asks.insertManyOrders(sell_orders)
+                    if table == self.book_table and message['data']:
+                        if table == 'orderBookL2' and self.depth is None:
+                            self.__add_checksum(message['data'], 1)
+                            timestamp = self.orderbook.getTimestamp()
+                            buy_orders = []
+                            sell_orders = []
+                            for order in message['data']:
+                                if order['side'] == 'Buy':
+                                    buy_orders.append(order)
+                                else:
+                                    sell_orders.append(order)
+                            buy_orders = list(map(lambda x: Bid(x['id'], x['size'], x['price'], timestamp), buy_orders))
+                            sell_orders = list(map(lambda x: Ask(x['id'], x['size'], x['price'], timestamp), sell_orders))
+                            self.orderbook.bids.insertManyOrders(buy_orders)
+                            self.orderbook.asks.insertManyOrders(sell_orders)
 
                         # write into MongoDB
                         timestamp = datetime.datetime.utcnow().timestamp()
@@ -351,22 +410,25 @@ class BitMEXWebsocket:
                         item = find_by_keys(self.keys[table], self.data[table], updateData)
                         if not item:
                             return  # No item found to update. Could happen before push
+                        if table == 'orderBookL2' and self.depth is None:
+                            self.__add_checksum([item], -1)
+                            self.__add_checksum([dict(item, **updateData)], 1)
                         item.update(updateData)
                         # Remove cancelled / filled orders
                         if table == 'order' and not order_leaves_quantity(item):
                             self.data[table].remove(item)
 
                     # update the snapshots in Redis
-                    if table in TARGET and message['data']:
+                    if table in self.targets and message['data']:
                         if table == 'margin':
                             self.red.hset(self.KEY_TEMPLATE_MARGIN, mapping=message['data'][0])
                         elif table == 'position':
                             self.red.hset(self.KEY_TEMPLATE_POSITION, mapping=message['data'][0])
-                        elif table == 'orderBookL2':
+                        elif table == 'orderBookL2' and self.depth is None:
                             bid_updates = []
                             ask_updates = []
                             for elm in message['data']:
-                                if elm['size'] == 'Buy':
+                                if elm['side'] == 'Buy':
                                     if self.orderbook.bids.orderExists(elm['id']):
                                         bid_updates.append(elm)
                                 else:
@@ -387,14 +449,17 @@ class BitMEXWebsocket:
                     for deleteData in message['data']:
                         item = find_by_keys(self.keys[table], self.data[table], deleteData)
                         self.data[table].remove(item)
+                        if table == 'orderBookL2' and self.depth is None:
+                            self.__add_checksum([item], -1)
 
                     # update the snapshots in Redis
-                    if table == 'orderBookL2' and message['data']:
-                        for elm in message['data']:
-                            orderId = elm['id']
-                            side = elm['side']
-                            tree = self.orderbook.bids if side == 'Buy' else self.orderbook.asks
-                            tree.removeOrderById(orderId)
+                    if table == self.book_table and message['data']:
+                        if table == 'orderBookL2' and self.depth is None:
+                            for elm in message['data']:
+                                orderId = elm['id']
+                                side = elm['side']
+                                tree = self.orderbook.bids if side == 'Buy' else self.orderbook.asks
+                                tree.removeOrderById(orderId)
 
                         # write into MongoDB
                         timestamp = datetime.datetime.utcnow().timestamp()
@@ -402,9 +467,156 @@ class BitMEXWebsocket:
 
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                # the light profiles keep only the top of the book in Redis
+                if table == self.book_table and self.depth is not None:
+                    if table != 'orderBookL2' or self.__touches_top(action, message['data']):
+                        self.__mirror_top()
+
+                if table == self.book_table and time.time() >= self.next_verify:
+                    self.next_verify = time.time() + BitMEXWebsocket.VERIFY_INTERVAL
+                    self.verify_book()
+
+                # bars, closed by a trade of a later interval or once their interval is over
+                closed = []
+                if table == 'trade' and action == 'insert':
+                    late = self.bars.lateTrades
+                    closed += self.bars.add_trades(message['data'])
+                    if self.bars.lateTrades > late:
+                        self.logger.warning('%d trades arrived after their bar was closed, left out of it.'
+                                            % (self.bars.lateTrades - late))
+                # by exchange time, the local clock may be ahead of BitMEX
+                if message['data'] and isinstance(message['data'][-1], dict):
+                    t = trade_time(message['data'][-1])  # any row with a timestamp
+                    if t is not None and t > self.exchange_time:
+                        self.exchange_time = t
+                if self.exchange_time:
+                    closed += self.bars.close_expired(self.exchange_time - BitMEXWebsocket.BAR_GRACE)
+                if closed:
+                    self.__publish_bars(closed)
         except:
             self.logger.error(traceback.format_exc())
 
+    def verify_book(self):
+        '''
+        Compare the checksums of the local and the Redis order book. A side that
+        diverged is rebuilt in Redis from the local table. Costs one GET per side.
+        Returns the sides that were rebuilt.
+        '''
+        resynced = []
+        for side, tree in (('bid', self.orderbook.bids), ('ask', self.orderbook.asks)):
+            if self.depth is None:
+                local = self.checksum[side]
+            else:
+                local = sum(levelChecksum(orderId, side, price, size)
+                            for price, (orderId, size) in self.levels[side].items())
+            if tree.checksum() == local:
+                continue
+
+            self.logger.warning('%s side of the Redis order book diverged, resyncing.' % side)
+            resynced.append(side)
+            tree.clear()
+            if self.depth is None:
+                timestamp = self.orderbook.getTimestamp()
+                cls, bmSide = (Bid, 'Buy') if side == 'bid' else (Ask, 'Sell')
+                tree.insertManyOrders([cls(x['id'], x['size'], x['price'], timestamp)
+                                       for x in self.data['orderBookL2'] if x['side'] == bmSide])
+            else:
+                self.levels[side] = {}
+                self.__mirror_top()
+        return resynced
+
+    def __publish_bars(self, bars):
+        '''Write closed bars into Redis and MongoDB.'''
+        with self.red.pipeline() as pipe:
+            for bar in bars:
+                key = self.KEY_TEMPLATE_BARS % bar['resolution']
+                pipe.rpush(key, json.dumps(bar))
+                pipe.ltrim(key, -BitMEXWebsocket.MAX_BARS, -1)
+            pipe.execute()
+
+        timestamp = datetime.datetime.utcnow().timestamp()
+        self.db_queue.put((timestamp, {'table': 'bars', 'action': 'insert', 'data': bars}))
+
+    def __add_checksum(self, orders, sign):
+        '''Add (sign=1) or remove (sign=-1) orderBookL2 rows to/from the local checksums.'''
+        for o in orders:
+            side = 'bid' if o['side'] == 'Buy' else 'ask'
+            self.checksum[side] += sign * levelChecksum(o['id'], side, o['price'], o['size'])
+
+    def __touches_top(self, action, rows):
+        '''
+        Whether orderBookL2 rows can change the top levels kept in Redis. Rows below the
+        last of these levels can't, and the full table isn't scanned for them.
+        '''
+        if action == 'partial':
+            return True
+        for row in rows:
+            side = 'bid' if row['side'] == 'Buy' else 'ask'
+            top = self.levels[side]
+            if any(orderId == row['id'] for orderId, _ in top.values()):
+                return True
+            # a price doesn't change on update, so only an insert can come into the top
+            if action == 'insert':
+                if len(top) < self.depth:
+                    return True
+                if row['price'] >= min(top) if side == 'bid' else row['price'] <= max(top):
+                    return True
+        return False
+
+    def __top_levels(self):
+        '''
+        Derive the top levels of both sides from the local order book table.
+        Returns two lists of (orderId, price, size), best price first.
+        '''
+        table = self.data[self.book_table]
+        if self.book_table == 'orderBookL2':
+            bids = heapq.nlargest(self.depth, (o for o in table if o['side'] == 'Buy'), key=lambda o: o['price'])
+            asks = heapq.nsmallest(self.depth, (o for o in table if o['side'] == 'Sell'), key=lambda o: o['price'])
+            return ([(o['id'], o['price'], o['size']) for o in bids],
+                    [(o['id'], o['price'], o['size']) for o in asks])
+
+        # orderBook10 and quote carry no order ids, so the price is used as the id
+        if not table:
+            return [], []
+        if self.book_table == 'orderBook10':
+            row = table[0]
+            bids = [(price, size) for price, size in row['bids'][:self.depth]]
+            asks = [(price, size) for price, size in row['asks'][:self.depth]]
+        else:  # quote
+            row = table[-1]
+            bids = [(row['bidPrice'], row['bidSize'])] if row['bidPrice'] != '' else []
+            asks = [(row['askPrice'], row['askSize'])] if row['askPrice'] != '' else []
+        return ([('%s-bid-%s' % (self.symbol, p), p, q) for p, q in bids],
+                [('%s-ask-%s' % (self.symbol, p), p, q) for p, q in asks])
+
+    def __mirror_top(self):
+        '''
+        Bring the Redis order book in line with the locally derived top levels,
+        writing only the levels that changed.
+        '''
+        timestamp = self.orderbook.getTimestamp()
+        for side, tree, cls, levels in zip(('bid', 'ask'), (self.orderbook.bids, self.orderbook.asks),
+                                           (Bid, Ask), self.__top_levels()):
+            current = self.levels[side]
+            new = {price: (orderId, size) for orderId, price, size in levels}
+
+            for price, (orderId, size) in list(current.items()):
+                if price not in new or new[price][0] != orderId:
+                    tree.removeOrderById(orderId)
+                    del current[price]
+
+            inserts = []
+            updates = []
+            for price, (orderId, size) in new.items():
+                if price not in current:
+                    inserts.append(cls(orderId, size, price, timestamp))
+                elif current[price][1] != size:
+                    updates.append({'orderId': orderId, 'mapping': {'qty': size}})
+                current[price] = (orderId, size)
+            tree.insertManyOrders(inserts)
+            tree.updateManyOrders(updates)
+
     def __on_error(self, error):
         '''Called on fatal websocket errors. We exit on these.'''
         if not self.exited:
@@ -420,6 +632,52 @@ class BitMEXWebsocket:
         self.logger.info('Websocket Closed')
 
 
+def get_collection_names(symbol):
+    '''The collection names to use in MongoDB, by table.'''
+    return {'margin': '%s-%s-margin-%s' % (EXCH, symbol, ACCOUNT),
+            'position': '%s-%s-position-%s' % (EXCH, symbol, ACCOUNT),
+            'orderBookL2': '%s-%s-orderBookL2' % (EXCH, symbol),
+            'orderBook10': '%s-%s-orderBook10' % (EXCH, symbol),
+            'quote': '%s-%s-quote' % (EXCH, symbol),
+            'bars': '%s-%s-bars' % (EXCH, symbol)}
+
+
+def get_auth(api_key, api_secret):
+    '''Return auth headers. Will use API Keys if present.'''
+    if api_key:
+        # To auth to the WS using an API key, we generate a signature of a nonce and
+        # the WS API endpoint.
+        expires = generate_nonce()
+        return [
+            "api-expires: " + str(expires),
+            "api-signature: " + generate_signature(api_secret, 'GET', '/realtime', expires, ''),
+            "api-key:" + api_key
+        ]
+    else:
+        return []
+
+
+def get_url(endpoint, symbol, profile='full'):
+    '''
+    Generate a connection URL. We can define subscriptions right in the querystring.
+    Most subscription topics are scoped by the symbol we're listening to.
+    '''
+
+    # You can sub to orderBookL2 for all levels, or orderBook10 for top 10 levels & save bandwidth
+    symbolSubs = ["execution", "instrument", "order", "position", "quote", "trade"]
+    if PROFILES[profile]['table'] != 'quote':
+        symbolSubs.append(PROFILES[profile]['table'])
+    genericSubs = ["margin"]
+
+    subscriptions = [sub + ':' + symbol for sub in symbolSubs]
+    subscriptions += genericSubs
+
+    urlParts = list(urllib.parse.urlparse(endpoint))
+    urlParts[0] = urlParts[0].replace('http', 'ws')
+    urlParts[2] = "/realtime?subscribe={}".format(','.join(subscriptions))
+    return urllib.parse.urlunparse(urlParts)
+
+
 # Utility method for finding an item in the store.
 # When an update comes through on the websocket, we need to figure out which item in the array it is
 # in order to match that item.
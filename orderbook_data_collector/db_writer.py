@@ -8,37 +8,90 @@ Created on Wed Jun 17 17:14:45 2020
 
 import logging
 import json
+import time
+import datetime
 import traceback
+from queue import Empty
 
 from pymongo import MongoClient
+from pymongo.errors import CollectionInvalid, OperationFailure, ConnectionFailure
 
 from mongo_config import USER_NAME, PASSWORD, CLUSTER_NAME, DB_NAME
+from delta_codec import encode_rows, ENCODING
 
 DIR = '/Users/zhishe/myProjects/bitmex'
 
 MONGODB_URL = f"mongodb+srv://{USER_NAME}:{PASSWORD}@{CLUSTER_NAME}-cgkkq.mongodb.net/{DB_NAME}?retryWrites=true&w=majority"
 
+# How messages are stored.
+# 'document'   - one document per message
+# 'bucket'     - one document per table per bucket of messages, with start/end timestamps and a count
+# 'timeseries' - one document per message in a MongoDB time-series collection (MongoDB 5.0+),
+#                inserted a bucket at a time. Falls back to a regular collection on older servers.
+STORAGE_MODE = 'document'
 
-def write_to_db(keys, queue):
+# A bucket is written once it spans this many seconds or holds this many messages.
+BUCKET_SECONDS = 1
+BUCKET_MAX_COUNT = 1000
+
+# Store the rows of orderBookL2 messages packed by delta_codec.encode_rows instead of as
+# a list of documents. Such records carry an 'encoding' field, see delta_codec.decode_record.
+BINARY_ORDERBOOK = False
+
+# Seconds to wait before retrying a write while MongoDB can't be reached, doubled after
+# every failed attempt up to RETRY_MAX_DELAY.
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+
+def write_to_db(keys, queue, stop):
     """
     keys : dict
         table : collection name in MongoDB
 
-    queue : queue.Queue
+    queue : spill_queue.SpillQueue
         the communication channel. Data to write into MongoDB is read from queue.
+        Messages left over from a previous run are written first.
+
+    stop : threading.Event
+        set to stop writing. Whatever hasn't been written by then is put back into
+        the queue, which is closed, so it's written on the next start.
 
+    While MongoDB can't be reached, the message at hand is retried and nothing more
+    is taken off the queue.
     """
     db_writer = DB_Writer(keys)
     db_writer.start()
 
-    while True:
-        timestamp, message = queue.get()
-        if 'action' in message and message['action'] == 'terminate':  # signal to terminate
-            break
+    pending = None  # taken off the queue, not written yet
+    failed = False
+    delay = RETRY_DELAY
+    while not stop.is_set():
+        if pending is None and not failed:
+            try:
+                pending = queue.get(timeout=BUCKET_SECONDS)
+            except Empty:
+                pass
+            else:
+                if pending[1].get('action') == 'terminate':  # left in the queue by an older version
+                    pending = None
+
+        if pending is not None and db_writer.write(*pending):
+            pending = None
+        # on every message, not only when idle: a busy table mustn't hold back a quiet table's bucket
+        failed = not db_writer.flush(expired_only=True) or pending is not None
+
+        if failed:
+            stop.wait(delay)
+            delay = min(2 * delay, RETRY_MAX_DELAY)
         else:
-            db_writer.write(timestamp, message)
+            delay = RETRY_DELAY
 
+    db_writer.flush()
+    # oldest first
+    queue.unget(db_writer.take_pending() + ([pending] if pending is not None else []))
     db_writer.close()
+    queue.close()
 
 
 class DB_Writer:
@@ -50,6 +103,13 @@ class DB_Writer:
         self.keys = keys
         self.logger = setup_logger()
 
+        self.mode = STORAGE_MODE
+        self.buckets = {}  # table : list of (timestamp, message) not written yet
+        # table : time.monotonic() when its bucket was opened. Buckets age by this rather than by
+        # the timestamps of their messages, which are old when a backlog is written after an outage.
+        self.opened = {}
+        self.ready = False  # collections set up, see setup()
+
     def start(self):
         """
         Connect to MongoDB Atlas.
@@ -59,12 +119,77 @@ class DB_Writer:
         self.db = self.client[DB_NAME]
         self.logger.debug('Connected to MongoDB.')
 
+    def setup(self):
+        """
+        Create the indexes and collections of the storage mode. Done before the first write,
+        as part of it: if MongoDB can't be reached, False is returned and it's retried with
+        the write.
+        """
+        if self.ready:
+            return True
+        try:
+            if self.mode == 'bucket':
+                for collection_name in self.keys.values():
+                    self.db[collection_name].create_index('start')
+            elif self.mode == 'timeseries':
+                for collection_name in self.keys.values():
+                    try:
+                        self.db.create_collection(collection_name, timeseries={'timeField': 'time',
+                                                                               'metaField': 'action',
+                                                                               'granularity': 'seconds'})
+                    except CollectionInvalid:
+                        pass  # already exists
+                    except OperationFailure:
+                        self.logger.error('Time-series collections not supported, using a regular collection.')
+        except ConnectionFailure:
+            self.logger.error(traceback.format_exc())
+            return False
+        self.ready = True
+        return True
+
     def write(self, timestamp, message):
         """
         Write data to MongoDB.
+
+        Returns False if MongoDB couldn't be reached and the message wasn't taken, True
+        otherwise. A message that can't be stored for any other reason is logged and dropped.
         """
         self.logger.debug(json.dumps(message))
 
+        table = message.get('table')
+
+        if self.mode != 'document':
+            bucket = self.buckets.get(table)
+            if bucket and (len(bucket) >= BUCKET_MAX_COUNT or timestamp - bucket[0][0] >= BUCKET_SECONDS):
+                # the bucket is full, or the message is outside its interval
+                if not self.write_bucket(table):
+                    return False
+            if table not in self.buckets:
+                self.opened[table] = time.monotonic()
+            bucket = self.buckets.setdefault(table, [])
+            bucket.append((timestamp, message))
+            if len(bucket) >= BUCKET_MAX_COUNT:
+                self.write_bucket(table)  # retried when the next message comes if it fails
+            return True
+
+        if not self.setup():
+            return False
+
+        collection_name = self.keys.get(table)
+        
+        try:
+            self.db[collection_name].insert_one(self.record(timestamp, message))
+        except ConnectionFailure:
+            self.logger.error(traceback.format_exc())
+            return False
+        except:
+            self.logger.error(traceback.format_exc())
+        return True
+
+    def record(self, timestamp, message):
+        """
+        The document stored for a message.
+        """
         # action is used to differentiate between snapshot and real-time update data
 
         # 'partial' - full table image - snapshot
@@ -72,16 +197,71 @@ class DB_Writer:
         # 'update'  - update row - real-time update
         # 'delete'  - delete row - real-time update
 
-        table = message.get('table')
-        action = message.get('action')  
-        data = {'timestamp': timestamp, 'action': action, 'data': message['data']}
+        data = {'timestamp': timestamp, 'action': message.get('action'), 'data': message['data']}
+        if BINARY_ORDERBOOK and message.get('table') == 'orderBookL2':
+            try:
+                data['data'] = encode_rows(message['data'])
+                data['encoding'] = ENCODING
+            except Exception:
+                # rows that can't be packed, e.g. '' left by helper_dict_clean for a null
+                # size or price, are stored as they are
+                self.logger.error(traceback.format_exc())
+        return data
+
+    def write_bucket(self, table):
+        """
+        Write the pending messages of a table as one bucket. If MongoDB can't be reached,
+        they stay pending and False is returned.
+        """
+        bucket = self.buckets.get(table)
+        if not bucket:
+            return True
+        if not self.setup():
+            return False
 
         collection_name = self.keys.get(table)
-        
+
         try:
-            self.db[collection_name].insert_one(data)
+            records = [self.record(timestamp, message) for timestamp, message in bucket]
+            if self.mode == 'bucket':
+                self.db[collection_name].insert_one({'start': records[0]['timestamp'],
+                                                     'end': records[-1]['timestamp'],
+                                                     'count': len(records),
+                                                     'messages': records})
+            else:
+                for data in records:
+                    data['time'] = datetime.datetime.utcfromtimestamp(data['timestamp'])
+                self.db[collection_name].insert_many(records, ordered=True)
+        except ConnectionFailure:
+            self.logger.error(traceback.format_exc())
+            return False
         except:
             self.logger.error(traceback.format_exc())
+        del self.buckets[table]
+        del self.opened[table]
+        return True
+
+    def flush(self, expired_only=False):
+        """
+        Write the pending buckets, or only those opened BUCKET_SECONDS ago or more.
+        Returns False if some couldn't be written.
+        """
+        now = time.monotonic()
+        ok = True
+        for table in list(self.buckets):
+            if not expired_only or now - self.opened[table] >= BUCKET_SECONDS:
+                ok = self.write_bucket(table) and ok
+        return ok
+
+    def take_pending(self):
+        """
+        Remove and return the messages of the buckets not written yet, as (timestamp, message),
+        oldest first.
+        """
+        pending = sorted((item for bucket in self.buckets.values() for item in bucket), key=lambda item: item[0])
+        self.buckets = {}
+        self.opened = {}
+        return pending
 
     def close(self):
         """
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact binary encoding of stored orderBookL2 rows.
+
+A stored orderBookL2 message repeats 'symbol' and 'side' strings on every row
+and keeps ids, sizes and prices as JSON/BSON numbers. Here the rows of one
+message are packed column by column:
+
+    symbol, side  : dictionary encoded, one byte per row
+    id            : first id as int64, then the differences to the previous id
+    size          : packed integers
+    price         : derived from the id where possible, BitMEX ids being
+                    (100000000 * index - price / tickSize); float64 otherwise
+
+Decoding gives back the same rows, field for field. Fields other than the five
+above are kept as JSON on the side.
+
+Run this module with a websocket.log recorded at DEBUG level to compare the
+size and the encode/decode cost with the format stored today:
+
+    python delta_codec.py ../websocket.log
+
+@author: zhishe
+"""
+
+import sys
+import json
+import time
+import struct
+from array import array
+
+VERSION = 1
+ENCODING = 'delta%d' % VERSION  # 'encoding' field of the stored records
+
+# row mask bits, the fields present in a row
+HAS_SYMBOL = 1
+HAS_ID = 2
+HAS_SIDE = 4
+HAS_SIZE = 8
+HAS_PRICE = 16
+PRICE_DERIVED = 32  # price is computed from the id, not stored
+PRICE_INT = 64  # price was an int in the message
+
+# header flags
+SIZES_FLOAT = 1
+HAS_EXTRAS = 2
+
+FIELDS = ('symbol', 'id', 'side', 'size', 'price')
+
+ID_SPAN = 100000000  # ids of one instrument are (ID_SPAN * index - price / tickSize)
+
+HEADER = struct.Struct('<BBI')  # version, flags, row count
+
+
+def _derive_price(orderId, tick):
+    index = -(-orderId // ID_SPAN)
+    return (index * ID_SPAN - orderId) * tick
+
+
+def _infer_tick(orderId, price):
+    """
+    The tick size of an instrument, from one of its rows. Rounded so that the
+    prices of the other rows are derived exactly; rows for which they aren't
+    simply keep their price.
+    """
+    steps = -(-orderId // ID_SPAN) * ID_SPAN - orderId
+    if not steps or not price:
+        return 0.0
+    return float('%.6g' % (price / steps))
+
+
+def _pack_ints(values):
+    """
+    Pack integers as int32 if they all fit, int64 otherwise. Returns bytes with a
+    one byte type code in front.
+    """
+    code = 'i' if all(-2 ** 31 <= v < 2 ** 31 for v in values) else 'q'
+    return code.encode('ascii') + array(code, values).tobytes()
+
+
+def _unpack_ints(buf, pos, count):
+    code = chr(buf[pos])
+    a = array(code)
+    end = pos + 1 + a.itemsize * count
+    a.frombytes(buf[pos + 1:end])
+    return a.tolist(), end
+
+
+def _pack_strings(strings):
+    out = bytearray(struct.pack('<B', len(strings)))
+    for s in strings:
+        b = s.encode('utf-8')
+        out += struct.pack('<B', len(b)) + b
+    return bytes(out)
+
+
+def _unpack_strings(buf, pos):
+    n = buf[pos]
+    pos += 1
+    strings = []
+    for _ in range(n):
+        length = buf[pos]
+        strings.append(bytes(buf[pos + 1:pos + 1 + length]).decode('utf-8'))
+        pos += 1 + length
+    return strings, pos
+
+
+def encode_rows(rows):
+    """
+    rows : list of dict
+        the 'data' of an orderBookL2 message.
+
+    Returns bytes.
+    """
+    symbols = []
+    sides = []
+    ticks = {}  # symbol : tick size
+    masks = bytearray()
+    symbolIdx = bytearray()
+    sideIdx = bytearray()
+    ids = []
+    sizes = []
+    prices = []
+    extras = []
+
+    for i, row in enumerate(rows):
+        mask = 0
+        if 'symbol' in row:
+            mask |= HAS_SYMBOL
+            if row['symbol'] not in symbols:
+                symbols.append(row['symbol'])
+            symbolIdx.append(symbols.index(row['symbol']))
+        if 'id' in row:
+            mask |= HAS_ID
+            ids.append(row['id'])
+        if 'side' in row:
+            mask |= HAS_SIDE
+            if row['side'] not in sides:
+                sides.append(row['side'])
+            sideIdx.append(sides.index(row['side']))
+        if 'size' in row:
+            mask |= HAS_SIZE
+            sizes.append(row['size'])
+        if 'price' in row:
+            mask |= HAS_PRICE
+            price = row['price']
+            if isinstance(price, int):
+                mask |= PRICE_INT
+            symbol = row.get('symbol')
+            if 'id' in row and symbol not in ticks:
+                ticks[symbol] = _infer_tick(row['id'], price)
+            if 'id' in row and ticks[symbol] and _derive_price(row['id'], ticks[symbol]) == price:
+                mask |= PRICE_DERIVED
+            else:
+                prices.append(float(price))
+        masks.append(mask)
+
+        extra = {k: v for k, v in row.items() if k not in FIELDS}
+        if extra:
+            extras.append([i, extra])
+
+    flags = 0
+    if any(isinstance(size, float) for size in sizes):
+        flags |= SIZES_FLOAT
+    if extras:
+        flags |= HAS_EXTRAS
+
+    out = bytearray(HEADER.pack(VERSION, flags, len(rows)))
+    out += _pack_strings(symbols)
+    out += _pack_strings(sides)
+    out += struct.pack('<B', len(ticks))
+    for symbol, tick in ticks.items():
+        out += struct.pack('<Bd', symbols.index(symbol) if symbol in symbols else 255, tick)
+    out += masks + symbolIdx + sideIdx
+    if ids:
+        out += struct.pack('<q', ids[0])
+        out += _pack_ints([b - a for a, b in zip(ids, ids[1:])])
+    if sizes:
+        if flags & SIZES_FLOAT:
+            out += array('d', sizes).tobytes()
+        else:
+            out += _pack_ints(sizes)
+    out += array('d', prices).tobytes()
+    if extras:
+        out += json.dumps(extras, separators=(',', ':')).encode('utf-8')
+    return bytes(out)
+
+
+def decode_rows(buf):
+    """
+    The inverse of encode_rows.
+    """
+    buf = memoryview(buf)
+    version, flags, n = HEADER.unpack_from(buf, 0)
+    if version != VERSION:
+        raise ValueError('unknown encoding version %d' % version)
+    pos = HEADER.size
+
+    symbols, pos = _unpack_strings(buf, pos)
+    sides, pos = _unpack_strings(buf, pos)
+    ticks = {}
+    nTicks = buf[pos]
+    pos += 1
+    for _ in range(nTicks):
+        idx, tick = struct.unpack_from('<Bd', buf, pos)
+        ticks[symbols[idx] if idx != 255 else None] = tick
+        pos += 9
+
+    masks = buf[pos:pos + n]
+    pos += n
+    nSymbols = sum(1 for m in masks if m & HAS_SYMBOL)
+    symbolIdx = buf[pos:pos + nSymbols]
+    pos += nSymbols
+    nSides = sum(1 for m in masks if m & HAS_SIDE)
+    sideIdx = buf[pos:pos + nSides]
+    pos += nSides
+
+    nIds = sum(1 for m in masks if m & HAS_ID)
+    ids = []
+    if nIds:
+        ids = [struct.unpack_from('<q', buf, pos)[0]]
+        deltas, pos = _unpack_ints(buf, pos + 8, nIds - 1)
+        for d in deltas:
+            ids.append(ids[-1] + d)
+
+    nSizes = sum(1 for m in masks if m & HAS_SIZE)
+    sizes = []
+    if nSizes:
+        if flags & SIZES_FLOAT:
+            a = array('d')
+            a.frombytes(buf[pos:pos + 8 * nSizes])
+            sizes = a.tolist()
+            pos += 8 * nSizes
+        else:
+            sizes, pos = _unpack_ints(buf, pos, nSizes)
+
+    nPrices = sum(1 for m in masks if m & HAS_PRICE and not m & PRICE_DERIVED)
+    a = array('d')
+    a.frombytes(buf[pos:pos + 8 * nPrices])
+    prices = a.tolist()
+    pos += 8 * nPrices
+
+    extras = {}
+    if flags & HAS_EXTRAS:
+        extras = {i: extra for i, extra in json.loads(bytes(buf[pos:]).decode('utf-8'))}
+
+    rows = []
+    iSymbol = iId = iSide = iSize = iPrice = 0
+    for i, mask in enumerate(masks):
+        row = {}
+        if mask & HAS_SYMBOL:
+            row['symbol'] = symbols[symbolIdx[iSymbol]]
+            iSymbol += 1
+        if mask & HAS_ID:
+            row['id'] = ids[iId]
+            iId += 1
+        if mask & HAS_SIDE:
+            row['side'] = sides[sideIdx[iSide]]
+            iSide += 1
+        if mask & HAS_SIZE:
+            row['size'] = sizes[iSize]
+            iSize += 1
+        if mask & HAS_PRICE:
+            if mask & PRICE_DERIVED:
+                price = _derive_price(row['id'], ticks[row.get('symbol')])
+            else:
+                price = prices[iPrice]
+                iPrice += 1
+            row['price'] = int(price) if mask & PRICE_INT else price
+        if i in extras:
+            row.update(extras[i])
+        rows.append(row)
+    return rows
+
+
+def decode_record(record):
+    """
+    Return a stored record with its 'data' as a list of rows, whether or not
+    it was stored encoded (see db_writer.BINARY_ORDERBOOK).
+    """
+    if record.get('encoding') == ENCODING:
+        record = dict(record, data=decode_rows(record['data']))
+        del record['encoding']
+    return record
+
+
+def main(path):
+    """
+    Compare stored record sizes and encode/decode times on the orderBookL2
+    messages of a recorded websocket.log.
+    """
+    try:
+        import bson
+
+        def stored_size(record):
+            return len(bson.encode(record))
+        unit = 'BSON'
+    except ImportError:
+        def stored_size(record):
+            if isinstance(record['data'], bytes):
+                return len(json.dumps(dict(record, data=''), separators=(',', ':'))) + len(record['data'])
+            return len(json.dumps(record, separators=(',', ':')))
+        unit = 'JSON'
+
+    messages = []
+    with open(path) as f:
+        for line in f:
+            i = line.find(' - DEBUG - {"table": "orderBookL2"')
+            if i >= 0:
+                messages.append(json.loads(line[i + len(' - DEBUG - '):]))
+    if not messages:
+        print('No orderBookL2 messages found in %s' % path)
+        return
+
+    nRows = sum(len(m['data']) for m in messages)
+    before = after = 0
+    encodeTime = decodeTime = 0
+    for m in messages:
+        before += stored_size({'timestamp': 0.0, 'action': m['action'], 'data': m['data']})
+
+        t = time.perf_counter()
+        encoded = encode_rows(m['data'])
+        encodeTime += time.perf_counter() - t
+
+        t = time.perf_counter()
+        decoded = decode_rows(encoded)
+        decodeTime += time.perf_counter() - t
+
+        if decoded != m['data']:
+            raise AssertionError('lossy round trip on %s' % json.dumps(m)[:200])
+        after += stored_size({'timestamp': 0.0, 'action': m['action'], 'data': encoded})
+
+    print('%d messages, %d rows' % (len(messages), nRows))
+    print('%s today  : %8.1f bytes/row' % (unit, before / nRows))
+    print('%s binary : %8.1f bytes/row' % (unit, after / nRows))
+    print('encode    : %8.2f us/row' % (encodeTime / nRows * 1e6))
+    print('decode    : %8.2f us/row' % (decodeTime / nRows * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'websocket.log')
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export the stored orderBookL2 history to Parquet for research.
+
+Records are streamed from MongoDB in large cursor batches and their 'data'
+rows flattened into typed columns:
+
+    timestamp (timestamp[us], UTC), action, symbol, id, side, price, size
+
+Files are partitioned the hive way, so pyarrow.dataset / pandas read the whole
+tree as one dataset:
+
+    <out>/symbol=XBTUSD/date=2020-06-18/part-<first _id>.parquet
+
+Runs are incremental in insertion order: the largest _id exported from each
+collection is kept in <out>/_export_state.json, and only documents with a
+larger _id are exported. Timestamps can't serve for this, as they are taken
+when a message is queued: messages written later, after a MongoDB outage from
+the spill queue or from a pending bucket, would be older than what was
+already exported and be skipped for good. Such late messages go to the date
+partition of their timestamp, in a part file of their own.
+
+Documents are exported once they are EXPORT_LAG seconds old, as the _id is
+set just before the insert. Days of insertion are exported in parallel by a
+process pool, each one a range of _id, which is indexed. Time-series
+collections have no index on _id and are scanned for each day.
+
+All storage layouts of db_writer are read: one document per message, buckets
+and time-series collections, with or without the binary row encoding.
+
+    python export.py --out /data/bitmex --symbols XBTUSD ETHUSD
+
+@author: zhishe
+"""
+
+import os
+import json
+import calendar
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING
+
+from db_writer import MONGODB_URL, DB_NAME
+from delta_codec import decode_record
+
+EXCH = 'BitMEX'
+
+BATCH_SIZE = 10000  # documents per cursor batch
+ROW_GROUP_ROWS = 1000000  # rows buffered before a row group is written
+
+SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('us', tz='UTC')),
+    ('action', pa.string()),
+    ('symbol', pa.string()),
+    ('id', pa.int64()),
+    ('side', pa.string()),
+    ('price', pa.float64()),
+    ('size', pa.int64()),
+])
+
+STATE_FILE = '_export_state.json'
+
+DAY = 86400
+
+EXPORT_LAG = 60  # seconds, documents inserted more recently are left for the next run
+
+
+def collection_name(symbol):
+    return '%s-%s-orderBookL2' % (EXCH, symbol)
+
+
+def is_timeseries(db, name):
+    info = next(db.list_collections(filter={'name': name}), None)
+    return info is not None and info.get('type') == 'timeseries'
+
+
+def to_seconds(dt):
+    """
+    A datetime from MongoDB (naive UTC) or an ObjectId (aware UTC) as seconds since the epoch.
+    """
+    return calendar.timegm(dt.utctimetuple())
+
+
+def object_id(seconds):
+    """
+    The smallest ObjectId generated at `seconds` since the epoch.
+    """
+    return ObjectId.from_datetime(datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc))
+
+
+def null_if_empty(value):
+    """
+    '' is what bitmex_websocket.helper_dict_clean leaves for a null, it goes in a numeric column as null.
+    """
+    return None if value == '' else value
+
+
+def iter_messages(collection, timeseries, lower, start, end):
+    """
+    Stored messages of the documents with lower < _id and start <= insertion time < end,
+    as (_id of the document, message), decoded. lower is None for no lower bound.
+    """
+    query = {'$gte': object_id(start), '$lt': object_id(end)}
+    if lower is not None:
+        query['$gt'] = lower
+    cursor = collection.find({'_id': query})
+    if not timeseries:
+        cursor = cursor.sort('_id', ASCENDING)  # walks the _id index
+    for doc in cursor.batch_size(BATCH_SIZE):
+        if 'messages' in doc:  # a bucket
+            for message in doc['messages']:
+                yield doc['_id'], decode_record(message)
+        else:
+            yield doc['_id'], decode_record(doc)
+
+
+def export_day(symbol, timeseries, day, lower, upper, out):
+    """
+    Export the documents inserted during one UTC day, before `upper` and with an _id greater
+    than `lower`. Runs in a worker process. Rows go to the date partition of their timestamp.
+    Returns (rows exported, largest _id exported, None if none).
+    """
+    client = MongoClient(MONGODB_URL)
+    collection = client[DB_NAME][collection_name(symbol)]
+
+    parts = {}  # date : [writer, path, columns]
+    rows = 0
+    last = None
+
+    def flush(part):
+        writer, path, columns = part
+        if writer is None:
+            writer = part[0] = pq.ParquetWriter(path, SCHEMA, compression='zstd')
+        writer.write_table(pa.table(columns, schema=SCHEMA))
+        for values in columns.values():
+            values.clear()
+
+    for _id, message in iter_messages(collection, timeseries, lower, day, min(day + DAY, upper)):
+        date = datetime.datetime.utcfromtimestamp(message['timestamp']).date().isoformat()
+        part = parts.get(date)
+        if part is None:
+            directory = os.path.join(out, 'symbol=%s' % symbol, 'date=%s' % date)
+            os.makedirs(directory, exist_ok=True)
+            part = parts[date] = [None, os.path.join(directory, 'part-%s.parquet' % _id),
+                                  {name: [] for name in SCHEMA.names}]
+        columns = part[2]
+
+        timestamp = datetime.datetime.fromtimestamp(message['timestamp'], datetime.timezone.utc)
+        for row in message['data']:
+            columns['timestamp'].append(timestamp)
+            columns['action'].append(message['action'])
+            columns['symbol'].append(row.get('symbol'))
+            columns['id'].append(null_if_empty(row.get('id')))
+            columns['side'].append(row.get('side'))
+            columns['price'].append(null_if_empty(row.get('price')))
+            columns['size'].append(null_if_empty(row.get('size')))
+        rows += len(message['data'])
+        last = _id if last is None else max(last, _id)
+
+        if len(columns['id']) >= ROW_GROUP_ROWS:
+            flush(part)
+
+    for part in parts.values():
+        if part[2]['id']:
+            flush(part)
+        if part[0] is not None:
+            part[0].close()
+    client.close()
+    return rows, None if last is None else str(last)
+
+
+def load_state(out):
+    path = os.path.join(out, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(out, state):
+    path = os.path.join(out, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def first_insert_time(collection, timeseries):
+    """
+    The insertion time of the first document of a collection, or a time before it, in seconds.
+    None if the collection is empty.
+    """
+    if timeseries:
+        # no index on _id; messages are inserted after their time
+        first = collection.find_one({}, sort=[('time', ASCENDING)])
+        return None if first is None else to_seconds(first['time'])
+    first = collection.find_one({}, sort=[('_id', ASCENDING)])
+    return None if first is None else to_seconds(first['_id'].generation_time)
+
+
+def export(symbols, out, workers=None):
+    os.makedirs(out, exist_ok=True)
+    state = load_state(out)
+
+    client = MongoClient(MONGODB_URL)
+    db = client[DB_NAME]
+
+    upper = int(datetime.datetime.utcnow().timestamp()) - EXPORT_LAG
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for symbol in symbols:
+            name = collection_name(symbol)
+            timeseries = is_timeseries(db, name)
+            if isinstance(state.get(name), (int, float)):
+                # a timestamp kept by earlier versions, taken as an insertion time
+                state[name] = str(object_id(state[name]))
+            if name in state:
+                lower = ObjectId(state[name])
+                start = to_seconds(lower.generation_time)
+            else:
+                lower = None
+                start = first_insert_time(db[name], timeseries)
+                if start is None:
+                    print('%s: empty' % name)
+                    continue
+
+            days = range(start // DAY * DAY, upper, DAY)
+            n = len(days)
+            results = list(pool.map(export_day, [symbol] * n, [timeseries] * n, days, [lower] * n,
+                                    [upper] * n, [out] * n))
+
+            rows = sum(r for r, _ in results)
+            ids = [ObjectId(last) for _, last in results if last is not None]
+            if lower is not None:
+                ids.append(lower)
+            if ids:
+                state[name] = str(max(ids))
+                save_state(out, state)
+            print('%s: %d rows over %d days of inserts, up to %s' % (
+                name, rows, n, ObjectId(state[name]).generation_time.isoformat() if ids else '-'))
+
+    client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export stored orderBookL2 history to Parquet.')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--symbols', nargs='+', default=['XBTUSD'])
+    parser.add_argument('--workers', type=int, default=None, help='processes, default one per CPU')
+    args = parser.parse_args()
+
+    export(args.symbols, args.out, args.workers)
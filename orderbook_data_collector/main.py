@@ -13,6 +13,18 @@ from bitmex_config import API_KEY, API_SECRET
 
 DB_NUM = 3  # Redis database number
 
+# Use a Redis Cluster instead of a single instance. The keys of each symbol share a hash tag,
+# so the symbols spread over the shards. A cluster has database 0 only.
+REDIS_CLUSTER = False
+CLUSTER_HOST = 'localhost'  # any node of the cluster, the others are discovered
+CLUSTER_PORT = 7000
+
+# Run the receiver, book and storage stages in separate processes, see pipeline.py
+MULTIPROCESS = False
+
+# Subscription profile, one of bitmex_websocket.PROFILES: 'full', 'l2_top', 'orderBook10', 'quote'
+PROFILE = 'full'
+
 
 def run():
 
@@ -29,11 +41,35 @@ def run():
 
 
 if __name__ == '__main__':
-    red = redis.StrictRedis(charset='utf-8', decode_responses=True, db=DB_NUM)
+    if MULTIPROCESS:
+        from pipeline import Pipeline
+
+        if REDIS_CLUSTER:
+            redis_kwargs = {'host': CLUSTER_HOST, 'port': CLUSTER_PORT, 'decode_responses': True}
+        else:
+            redis_kwargs = {'charset': 'utf-8', 'decode_responses': True, 'db': DB_NUM}
+
+        # the Redis client is created in the book process
+        pl = Pipeline(endpoint="https://testnet.bitmex.com/api/v1", symbol="XBTUSD",
+                      redis_kwargs=redis_kwargs, cluster=REDIS_CLUSTER,
+                      api_key=API_KEY, api_secret=API_SECRET, profile=PROFILE)
+
+        input('Press Enter to exit...')
+        print(pl.stats())
+        pl.exit()
+
+    else:
+        if REDIS_CLUSTER:
+            from redis.cluster import RedisCluster
+
+            # pipelines of a cluster client are split and sent per node
+            red = RedisCluster(host=CLUSTER_HOST, port=CLUSTER_PORT, decode_responses=True)
+        else:
+            red = redis.StrictRedis(charset='utf-8', decode_responses=True, db=DB_NUM)
 
-    # instantiate the WS will make it connect.
-    ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1", symbol="XBTUSD", red=red,
-                         api_key=API_KEY, api_secret=API_SECRET)
+        # instantiate the WS will make it connect.
+        ws = BitMEXWebsocket(endpoint="https://testnet.bitmex.com/api/v1", symbol="XBTUSD", red=red,
+                             api_key=API_KEY, api_secret=API_SECRET, profile=PROFILE)
 
-    input('Press Enter to exit...')
-    ws.exit()
+        input('Press Enter to exit...')
+        ws.exit()
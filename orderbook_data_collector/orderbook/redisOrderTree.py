@@ -4,6 +4,74 @@
 
 """
 
+import hashlib
+
+try:
+    from redis.cluster import RedisCluster  # redis-py 4.1+
+except ImportError:
+    RedisCluster = None
+
+# Each side of the book keeps a checksum in Redis: the sum of levelChecksum() over its orders.
+# A sum can be updated in O(1) on every insert, update and delete, and compared in O(1).
+# The hashes are 40 bits, so the sum fits in Redis' signed 64-bit integers for up to 2**23 orders.
+
+# h() is levelChecksum() in Lua, run `python -m orderbook.redisOrderTree` to check they agree.
+CHECKSUM_LUA = """
+local function fmt(x)
+    return string.format('%.14g', tonumber(x))
+end
+local function h(orderId, side, price, qty)
+    return tonumber(string.sub(redis.sha1hex(orderId .. '|' .. side .. '|' .. fmt(price) .. '|' .. fmt(qty)), 1, 10), 16)
+end
+"""
+
+# Update the qty of orders and their contribution to the checksum in one go, from the values
+# actually stored in Redis. Orders that aren't in Redis are left out.
+# KEYS[1] : checksum key, KEYS[2..] : order keys
+# ARGV[1] : side, ARGV[2..] : new qty, one per order key
+UPDATE_QTY_SCRIPT = CHECKSUM_LUA + """
+local side = ARGV[1]
+local delta = 0
+for i = 2, #KEYS do
+    local old = redis.call('HMGET', KEYS[i], 'orderId', 'price', 'qty')
+    if old[1] and old[2] and old[3] then
+        delta = delta - h(old[1], side, old[2], old[3]) + h(old[1], side, old[2], ARGV[i])
+        redis.call('HSET', KEYS[i], 'qty', ARGV[i])
+    end
+end
+if delta ~= 0 then
+    redis.call('INCRBY', KEYS[1], string.format('%.0f', delta))
+end
+return delta
+"""
+
+
+def isCluster(red):
+    return RedisCluster is not None and isinstance(red, RedisCluster)
+
+
+def keyPrefix(exchange, symbol, red):
+    """
+    The prefix of all Redis keys of a symbol, 'BitMEX-XBTUSD'.
+
+    On a Redis Cluster it's a hash tag, '{BitMEX-XBTUSD}', so that all keys of a
+    symbol hash to the same slot: the scripts and multi-key commands on them run
+    on one node, while different symbols spread over the shards.
+    """
+    prefix = '%s-%s' % (exchange, symbol)
+    return '{%s}' % prefix if isCluster(red) else prefix
+
+
+def levelChecksum(orderId, side, price, qty):
+    """
+    Hash of one order for the book checksum. Must match h() in UPDATE_QTY_SCRIPT.
+
+    side : str
+        'bid' or 'ask'
+    """
+    s = '%s|%s|%.14g|%.14g' % (orderId, side, float(price), float(qty))
+    return int(hashlib.sha1(s.encode('utf-8')).hexdigest()[:10], 16)
+
 
 class OrderTree:
     def __init__(self, exchange, symbol, side, red):
@@ -18,9 +86,15 @@ class OrderTree:
         self.side = side
         self.red = red
 
-        self.KEY_PRICE_TREE = '%s-%s-prices-%s' % (exchange, symbol, side)
-        self.KEY_TEMPLATE_ORDER = '%s-%s-order-%%s' % (exchange, symbol)  # order id
-        self.KEY_TEMPLATE_ORDERS_BY_PRICE = '%s-%s-%s-%%s' % (exchange, symbol, side)  # price
+        self.cluster = isCluster(red)
+
+        prefix = keyPrefix(exchange, symbol, red)
+        self.KEY_PRICE_TREE = '%s-prices-%s' % (prefix, side)
+        self.KEY_TEMPLATE_ORDER = '%s-order-%%s' % prefix  # order id
+        self.KEY_TEMPLATE_ORDERS_BY_PRICE = '%s-%s-%%s' % (prefix, side)  # price
+        self.KEY_CHECKSUM = '%s-checksum-%s' % (prefix, side)
+
+        self._updateQty = red.register_script(UPDATE_QTY_SCRIPT)
 
     def __len__(self):
         return self.red.zcard(self.KEY_PRICE_TREE)
@@ -31,6 +105,12 @@ class OrderTree:
     def orderExists(self, orderId):
         return self.red.exists(self.KEY_TEMPLATE_ORDER % orderId)
 
+    def checksum(self):
+        """
+        The checksum of this side of the book, see levelChecksum.
+        """
+        return int(self.red.get(self.KEY_CHECKSUM) or 0)
+
     def insertOrder(self, order):
         """
         order : Order
@@ -41,6 +121,7 @@ class OrderTree:
 
         self.red.hset(self.KEY_TEMPLATE_ORDER % order.orderId, mapping=order.__dict__)
         self.red.rpush(self.KEY_TEMPLATE_ORDERS_BY_PRICE % price, order.orderId)
+        self.red.incrby(self.KEY_CHECKSUM, levelChecksum(order.orderId, self.side, order.price, order.qty))
 
     def insertManyOrders(self, orderList):
         """
@@ -58,12 +139,14 @@ class OrderTree:
         # execute write operations in a batch to reduce the number of network round trips
         with self.red.pipeline() as pipe:  # in redis-py, Pipeline is a transactional pipeline class by default
             for order in orderList:
-                self.red.hset(self.KEY_TEMPLATE_ORDER % order.orderId, mapping=order.__dict__)
-                self.red.rpush(self.KEY_TEMPLATE_ORDERS_BY_PRICE % order.price, order.orderId)
+                pipe.hset(self.KEY_TEMPLATE_ORDER % order.orderId, mapping=order.__dict__)
+                pipe.rpush(self.KEY_TEMPLATE_ORDERS_BY_PRICE % order.price, order.orderId)
+            pipe.incrby(self.KEY_CHECKSUM, sum(levelChecksum(order.orderId, self.side, order.price, order.qty)
+                                               for order in orderList))
             pipe.execute()
 
     def updateOrder(self, orderId, mapping):
-        self.red.hset(self.KEY_TEMPLATE_ORDER % orderId, mapping=mapping)
+        self.updateManyOrders([{'orderId': orderId, 'mapping': mapping}])
 
     def updateManyOrders(self, updates):
         """
@@ -72,10 +155,22 @@ class OrderTree:
         if not updates:
             return
 
+        # qty goes through UPDATE_QTY_SCRIPT, which keeps the checksum in line
+        keys = [self.KEY_CHECKSUM]
+        args = [self.side]
+
         # execute write operations in a batch to reduce the number of network round trips
         with self.red.pipeline() as pipe:  # in redis-py, Pipeline is a transactional pipeline class by default
             for update in updates:
-                self.red.hset(self.KEY_TEMPLATE_ORDER % update['orderId'], mapping=update['mapping'])
+                mapping = {k: v for k, v in update['mapping'].items() if k != 'qty'}
+                if mapping:
+                    pipe.hset(self.KEY_TEMPLATE_ORDER % update['orderId'], mapping=mapping)
+                if 'qty' in update['mapping']:
+                    keys.append(self.KEY_TEMPLATE_ORDER % update['orderId'])
+                    args.append(update['mapping']['qty'])
+            if len(keys) > 1:
+                # a cluster pipeline can't load a script that isn't cached on the node yet
+                self._updateQty(keys=keys, args=args, client=self.red if self.cluster else pipe)
             pipe.execute()
 
     def removeOrderById(self, orderId):
@@ -84,6 +179,27 @@ class OrderTree:
         if not self.red.exists(self.KEY_TEMPLATE_ORDERS_BY_PRICE % order['price']):
             self.red.zrem(self.KEY_PRICE_TREE, order['price'])
         self.red.delete(self.KEY_TEMPLATE_ORDER % orderId)
+        self.red.decrby(self.KEY_CHECKSUM, levelChecksum(order['orderId'], self.side, order['price'], order['qty']))
+
+    def clear(self):
+        """
+        Remove every order on this side and reset the checksum.
+        """
+        prices = self.red.zrange(self.KEY_PRICE_TREE, 0, -1)
+
+        # read the orders of all price levels in one round trip
+        with self.red.pipeline() as pipe:
+            for price in prices:
+                pipe.lrange(self.KEY_TEMPLATE_ORDERS_BY_PRICE % price, 0, -1)
+            orderIds = pipe.execute()
+
+        with self.red.pipeline() as pipe:
+            for price, ids in zip(prices, orderIds):
+                for orderId in ids:
+                    pipe.delete(self.KEY_TEMPLATE_ORDER % orderId)
+                pipe.delete(self.KEY_TEMPLATE_ORDERS_BY_PRICE % price)
+            pipe.delete(self.KEY_PRICE_TREE, self.KEY_CHECKSUM)
+            pipe.execute()
 
     def removeManyOrders(self, orderIds):
         """
@@ -121,3 +237,41 @@ class OrderTree:
             res = pipe.execute()
         return res
 
+
+
+# ARGV : orderId, side, price, qty, ... Returns h() of each order.
+CHECKSUM_CHECK_SCRIPT = CHECKSUM_LUA + """
+local out = {}
+for i = 1, #ARGV, 4 do
+    out[#out + 1] = h(ARGV[i], ARGV[i + 1], ARGV[i + 2], ARGV[i + 3])
+end
+return out
+"""
+
+
+def main(db=15):
+    """
+    Check that levelChecksum() and h() of the Lua scripts give the same hashes, with
+    prices and quantities passed the way redis-py stores them. Needs a local Redis.
+
+        python -m orderbook.redisOrderTree
+    """
+    import redis
+
+    orders = [(8799000000 + i, side, price, qty)
+              for i, (price, qty) in enumerate([(10000, 1), (9123.5, 250), (9123.25, 1000000),
+                                                (0.00001234, 3), (0.5, 0), (123456.789, 2 ** 40),
+                                                (1e-08, 10), (38.05, 7), (1.1, 1.1), (99999999.5, 1)])
+              for side in ('bid', 'ask')]
+
+    red = redis.StrictRedis(decode_responses=True, db=db)
+    # redis-py turns the numbers into strings as it does for HSET
+    res = red.register_script(CHECKSUM_CHECK_SCRIPT)(keys=[], args=[v for order in orders for v in order])
+
+    for order, lua in zip(orders, res):
+        assert levelChecksum(*order) == lua, (order, levelChecksum(*order), lua)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Read side of the Redis order book.
+
+OrderTree.maxPriceList()/minPriceList() need a zrevrange, an lrange and a
+pipeline of hgetall, over several round trips that can interleave with the
+collector's writes. BookReader gets both sides in one call of a server-side
+script, which Redis runs atomically, and decodes them into NumPy arrays.
+
+    reader = BookReader('BitMEX', 'XBTUSD', red)
+    snap = reader.snapshot(depth=10)
+    snap.bidPrice, snap.bidQty, snap.askPrice, snap.askQty
+
+@author: Zhishe
+
+"""
+
+import numpy as np
+
+from .redisOrderTree import OrderTree
+
+# KEYS[1], KEYS[2] : price trees of bids and asks
+# KEYS[3], KEYS[4] : checksums of bids and asks, the version stamp of the snapshot
+# ARGV[1] : number of price levels per side, 0 for all
+# ARGV[2] : order key prefix, ARGV[3], ARGV[4] : orders-by-price key prefixes of bids and asks
+# ARGV[5], ARGV[6] : checksums the caller already has, '' for none
+# Returns {bidChecksum, askChecksum, bids, asks}, each side flat as {orderId, price, qty, ...}
+# best price first, or only {bidChecksum, askChecksum} if the checksums are the caller's.
+# The list and order keys are built in the script; on a Redis Cluster they share the hash tag
+# of KEYS, see redisOrderTree.keyPrefix, so they live on the same node.
+SNAPSHOT_SCRIPT = """
+local bidChecksum = redis.call('GET', KEYS[3]) or '0'
+local askChecksum = redis.call('GET', KEYS[4]) or '0'
+if bidChecksum == ARGV[5] and askChecksum == ARGV[6] then
+    return {bidChecksum, askChecksum}
+end
+local depth = tonumber(ARGV[1])
+local function side(tree, prefix, reverse)
+    local prices
+    if reverse then
+        prices = redis.call('ZREVRANGE', tree, 0, depth - 1)
+    else
+        prices = redis.call('ZRANGE', tree, 0, depth - 1)
+    end
+    local out = {}
+    for _, price in ipairs(prices) do
+        for _, orderId in ipairs(redis.call('LRANGE', prefix .. price, 0, -1)) do
+            local order = redis.call('HMGET', ARGV[2] .. orderId, 'price', 'qty')
+            out[#out + 1] = orderId
+            out[#out + 1] = order[1] or price
+            out[#out + 1] = order[2] or '0'
+        end
+    end
+    return out
+end
+return {bidChecksum, askChecksum, side(KEYS[1], ARGV[3], true), side(KEYS[2], ARGV[4], false)}
+"""
+
+
+class Snapshot:
+    def __init__(self, version, bids, asks):
+        """
+        version : tuple
+            changes whenever the book changes, see BookReader.
+        bids, asks : list
+            flat [orderId, price, qty, ...] as returned by SNAPSHOT_SCRIPT.
+        """
+        self.version = version
+        self.bidIds = np.array(bids[0::3])
+        self.bidPrice = np.array(bids[1::3], dtype=np.float64)
+        self.bidQty = np.array(bids[2::3], dtype=np.float64)
+        self.askIds = np.array(asks[0::3])
+        self.askPrice = np.array(asks[1::3], dtype=np.float64)
+        self.askQty = np.array(asks[2::3], dtype=np.float64)
+
+    def __repr__(self):
+        return 'Snapshot(version=%s, bids=%d, asks=%d)' % (self.version, len(self.bidPrice), len(self.askPrice))
+
+
+class BookReader:
+    def __init__(self, exchange, symbol, red):
+        """
+        exchange : str
+        symbol: str
+        red : redis.Redis
+        """
+        self.bids = OrderTree(exchange, symbol, 'bid', red)
+        self.asks = OrderTree(exchange, symbol, 'ask', red)
+        self._snapshot = red.register_script(SNAPSHOT_SCRIPT)
+        self._lastVersion = None
+
+    def snapshot(self, depth=None, version=None):
+        """
+        Both sides of the book as one consistent Snapshot, best price first.
+
+        depth : int
+            number of price levels per side, None for all.
+        version : tuple
+            version of a snapshot the caller already has. If the book is still at
+            that version, None is returned without transferring the book.
+
+        The version stamp is the pair of side checksums kept by OrderTree, so it
+        changes whenever the content of the book does.
+        """
+        known = ['%d' % v for v in version] if version else ['', '']
+        res = self._snapshot(
+            keys=[self.bids.KEY_PRICE_TREE, self.asks.KEY_PRICE_TREE,
+                  self.bids.KEY_CHECKSUM, self.asks.KEY_CHECKSUM],
+            args=[depth or 0, self.bids.KEY_TEMPLATE_ORDER % '',
+                  self.bids.KEY_TEMPLATE_ORDERS_BY_PRICE % '', self.asks.KEY_TEMPLATE_ORDERS_BY_PRICE % ''] + known)
+        if len(res) == 2:
+            return None
+        bidChecksum, askChecksum, bids, asks = res
+        return Snapshot((int(bidChecksum), int(askChecksum)), bids, asks)
+
+    def poll(self, depth=None):
+        """
+        Like snapshot(), but returns None if the book hasn't changed since the last poll.
+        """
+        snap = self.snapshot(depth, self._lastVersion)
+        if snap is not None:
+            self._lastVersion = snap.version
+        return snap
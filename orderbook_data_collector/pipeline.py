@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-process mode of the collector.
+
+In the default mode decoding, table maintenance, the Redis mirror and MongoDB
+serialization all share one interpreter. Here they run in three processes
+connected by shared-memory ring buffers:
+
+    receiver : reads the websocket and writes the raw frames into ring 'raw'
+    book     : decodes the frames, maintains the tables and the Redis mirror,
+               and writes the messages to store into ring 'store'
+    storage  : reads ring 'store' and writes into MongoDB
+
+A full ring blocks its writer, so a slow stage slows down the stages in front
+of it instead of growing memory. The storage stage drains its ring into a
+SpillQueue, so a stalled MongoDB ends up on local disk rather than blocking
+the book process. If a stage dies, the parent ends the rings around it, see
+Pipeline.supervise, so that the other stages stop instead of waiting forever.
+
+@author: zhishe
+"""
+
+import json
+import time
+import struct
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import redis
+import websocket
+
+from bitmex_websocket import BitMEXWebsocket, get_auth, get_url, get_collection_names, setup_logger, DIR, EXCH
+from db_writer import write_to_db
+from spill_queue import SpillQueue
+
+RING_SIZE = 64 * 1024 * 1024  # bytes of frame data per ring
+
+POLL_INTERVAL = 0.0005  # seconds to sleep when a ring is full / empty
+
+SUPERVISE_INTERVAL = 1  # seconds between two checks of the processes
+JOIN_TIMEOUT = 60  # seconds exit() waits for a process before terminating it
+
+# Ring header: read and write positions, counters and the finished and abandoned flags, as uint64.
+# Positions are byte counts since the ring was created and only ever increase.
+HEAD, TAIL, PUTS, GETS, BYTES, FULL_WAITS, FINISHED, ABANDONED = range(8)
+HEADER_SIZE = 64
+
+FRAME = struct.Struct('<I')  # frame length prefix
+WRAP = 0xFFFFFFFF  # frame length marking the rest of the ring as unused
+
+
+class RingBuffer:
+    """
+    Single-producer single-consumer ring of length-prefixed frames in shared memory.
+
+    The producer only writes HEAD and the consumer only writes TAIL, each after the
+    frame data it covers. Plain stores to shared memory carry no memory barrier, and
+    on ARM (Apple Silicon) the other process could see a new HEAD before the frame
+    data. So the header is only read and written while holding a lock shared by both
+    processes; taking and releasing it orders the frame data before the position.
+    """
+
+    def __init__(self, handle=None, size=RING_SIZE):
+        """
+        handle : tuple
+            the handle of an existing ring to attach to, see RingBuffer.handle. If None,
+            a new ring is created.
+        size : int
+            bytes of frame data, only used when creating.
+        """
+        if handle is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + size)
+            self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            self.lock = mp.Lock()
+            self.owner = True
+        else:
+            name, self.lock = handle
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.handle = (self.name, self.lock)  # passed to the processes attaching to the ring
+        self.capacity = self.shm.size - HEADER_SIZE
+        self.header = self.shm.buf[:HEADER_SIZE].cast('Q')
+        self.buf = self.shm.buf[HEADER_SIZE:]
+
+    def write(self, payload):
+        """
+        Append one frame. Blocks while the ring is full.
+        Raises BrokenPipeError once the consumer is gone, see abandon().
+        """
+        if self._load(ABANDONED):
+            raise BrokenPipeError('the consumer of the ring is gone')
+        need = FRAME.size + len(payload)
+        if need > self.capacity // 2:
+            raise ValueError('frame of %d bytes is too large for the ring' % len(payload))
+
+        head = self._load(HEAD)
+        offset = head % self.capacity
+        pad = self.capacity - offset if self.capacity - offset < need else 0
+        while self.capacity - (head - self._load(TAIL)) < pad + need:
+            if self._load(ABANDONED):
+                raise BrokenPipeError('the consumer of the ring is gone')
+            with self.lock:
+                self.header[FULL_WAITS] += 1
+            time.sleep(POLL_INTERVAL)
+
+        if pad:
+            # not enough room before the end of the ring, continue at its start
+            if pad >= FRAME.size:
+                FRAME.pack_into(self.buf, offset, WRAP)
+            head += pad
+            offset = 0
+        FRAME.pack_into(self.buf, offset, len(payload))
+        self.buf[offset + FRAME.size:offset + need] = payload
+
+        with self.lock:
+            self.header[PUTS] += 1
+            self.header[BYTES] += len(payload)
+            self.header[HEAD] = head + need  # publish the frame
+
+    def read(self):
+        """
+        Remove and return the oldest frame as bytes. Blocks while the ring is empty.
+        Returns None once the ring is empty and the producer has finished.
+        """
+        tail = self._load(TAIL)
+        while self._load(HEAD) == tail:
+            with self.lock:
+                if self.header[FINISHED] and self.header[HEAD] == tail:  # the last frame may just have landed
+                    return None
+            time.sleep(POLL_INTERVAL)
+
+        offset = tail % self.capacity
+        if self.capacity - offset < FRAME.size or FRAME.unpack_from(self.buf, offset)[0] == WRAP:
+            tail += self.capacity - offset
+            offset = 0
+        length = FRAME.unpack_from(self.buf, offset)[0]
+        payload = bytes(self.buf[offset + FRAME.size:offset + FRAME.size + length])
+
+        with self.lock:
+            self.header[GETS] += 1
+            self.header[TAIL] = tail + FRAME.size + length  # release the space
+        return payload
+
+    def _load(self, index):
+        with self.lock:
+            return self.header[index]
+
+    def put(self, item):
+        """
+        Queue-like interface for JSON serializable items, see SpillQueue.
+        """
+        self.write(json.dumps(item).encode('utf-8'))
+
+    def get(self):
+        payload = self.read()
+        if payload is None:
+            return None
+        item = json.loads(payload)
+        return tuple(item) if isinstance(item, list) else item
+
+    def finish(self):
+        """
+        Called by the producer after its last frame.
+        """
+        with self.lock:
+            self.header[FINISHED] = 1
+
+    def abandon(self):
+        """
+        Called when the consumer is gone, so that the producer doesn't block forever on a full ring.
+        """
+        with self.lock:
+            self.header[ABANDONED] = 1
+
+    def abandoned(self):
+        return bool(self._load(ABANDONED))
+
+    def stats(self):
+        with self.lock:
+            return {'puts': self.header[PUTS],
+                    'gets': self.header[GETS],
+                    'bytes': self.header[BYTES],
+                    'depth': self.header[HEAD] - self.header[TAIL],
+                    'full_waits': self.header[FULL_WAITS]}
+
+    def close(self):
+        self.header.release()
+        self.buf.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+#
+# Stages. Each one runs in its own process and attaches to the rings by name.
+#
+
+class Receiver:
+    """
+    Reads the websocket and writes the raw frames into the ring, nothing else.
+    """
+
+    def __init__(self, endpoint, symbol, profile, api_key, api_secret, ring, stop):
+        self.logger = setup_logger()
+        self.ring = RingBuffer(ring)
+        self.stop = stop
+
+        wsURL = get_url(endpoint, symbol, profile)
+        self.logger.info("Receiver connecting to %s" % wsURL)
+        self.ws = websocket.WebSocketApp(wsURL,
+                                         on_message=self.__on_message,
+                                         on_error=self.__on_error,
+                                         header=get_auth(api_key, api_secret))
+
+    def run(self):
+        wst = threading.Thread(target=lambda: self.ws.run_forever())
+        wst.daemon = True
+        wst.start()
+        while not self.stop.is_set() and wst.is_alive():
+            time.sleep(0.1)
+        self.ws.close()
+        wst.join(5)
+        self.ring.finish()
+        self.ring.close()
+
+    def __on_message(self, message):
+        try:
+            self.ring.write(message.encode('utf-8'))
+        except BrokenPipeError:
+            self.logger.error('Book process is gone, closing the websocket.')
+            self.ws.close()
+
+    def __on_error(self, error):
+        self.logger.error("Error : %s" % error)
+
+
+def run_receiver(endpoint, symbol, profile, api_key, api_secret, ring, stop):
+    Receiver(endpoint, symbol, profile, api_key, api_secret, ring, stop).run()
+
+
+def run_book(endpoint, symbol, profile, redis_kwargs, cluster, api_key, api_secret, raw_ring, store_ring):
+    """
+    Decode the frames and maintain the tables and the Redis mirror.
+    """
+    raw = RingBuffer(raw_ring)
+    store = RingBuffer(store_ring)
+
+    if cluster:
+        from redis.cluster import RedisCluster
+        red = RedisCluster(**redis_kwargs)
+    else:
+        red = redis.StrictRedis(**redis_kwargs)
+    book = BitMEXWebsocket(endpoint, symbol, red, api_key=api_key, api_secret=api_secret,
+                           db_queue=store, connect=False, profile=profile)
+    while not store.abandoned():
+        frame = raw.read()
+        if frame is None:
+            break
+        book.process_message(frame.decode('utf-8'))
+
+    if store.abandoned():
+        book.logger.error('Storage process is gone, stopping.')
+    else:
+        book.exit()  # sends the terminate signal down to the storage process
+    store.finish()
+    raw.close()
+    store.close()
+
+
+def run_storage(symbol, store_ring):
+    """
+    Write the messages into MongoDB.
+    """
+    store = RingBuffer(store_ring)
+
+    spool = SpillQueue('%s/spool/%s-%s' % (DIR, EXCH, symbol))
+    stop = threading.Event()
+    dbt = threading.Thread(target=write_to_db, args=(get_collection_names(symbol), spool, stop))
+    dbt.start()
+
+    while True:
+        item = store.get()
+        if item is None or item[1].get('action') == 'terminate':  # None: book process died without it
+            break
+        spool.put(item)
+
+    # messages not written yet stay in the spool for the next start
+    stop.set()
+    dbt.join()
+    store.close()
+
+
+class Pipeline:
+    """
+    Starts and supervises the three processes. Same lifetime as BitMEXWebsocket:
+    it runs from construction until exit() is called.
+    """
+
+    def __init__(self, endpoint, symbol, redis_kwargs, api_key=None, api_secret=None, ring_size=RING_SIZE,
+                 profile='full', cluster=False):
+        """
+        redis_kwargs : dict
+            keyword arguments of redis.StrictRedis, the client is created in the book process.
+        cluster : bool
+            connect to a Redis Cluster, redis_kwargs are then those of redis.cluster.RedisCluster.
+        profile : str
+            subscription profile, see bitmex_websocket.PROFILES.
+        """
+        self.logger = setup_logger()
+        self.symbol = symbol
+
+        self.raw = RingBuffer(size=ring_size)
+        self.store = RingBuffer(size=ring_size)
+        self.stop = mp.Event()
+
+        self.processes = [
+            mp.Process(target=run_receiver, name='receiver',
+                       args=(endpoint, symbol, profile, api_key, api_secret, self.raw.handle, self.stop)),
+            mp.Process(target=run_book, name='book',
+                       args=(endpoint, symbol, profile, redis_kwargs, cluster, api_key, api_secret,
+                             self.raw.handle, self.store.handle)),
+            mp.Process(target=run_storage, name='storage',
+                       args=(symbol, self.store.handle)),
+        ]
+        for p in self.processes:
+            p.start()
+
+        self._last = (time.time(), self.stats())
+
+        self._closing = threading.Event()
+        self._supervisor = threading.Thread(target=self.supervise)
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def is_alive(self):
+        return all(p.is_alive() for p in self.processes)
+
+    def supervise(self):
+        """
+        Runs in a thread until exit(). When a process dies, the rings around it are ended:
+        the one it writes is marked finished, so its consumer doesn't wait forever, and the
+        one it reads is abandoned, so its producer doesn't block forever on a full ring.
+        """
+        writes = {'receiver': self.raw, 'book': self.store}
+        reads = {'book': self.raw, 'storage': self.store}
+        dead = set()
+        while not self._closing.wait(SUPERVISE_INTERVAL):
+            if self.is_alive():
+                continue
+            for p in self.processes:
+                if p.is_alive() or p.name in dead:
+                    continue
+                dead.add(p.name)
+                if p.exitcode:
+                    self.logger.error('%s process died, exit code %s.' % (p.name, p.exitcode))
+                if p.name in writes:
+                    writes[p.name].finish()
+                if p.name in reads:
+                    reads[p.name].abandon()
+
+    def stats(self):
+        """
+        Counters per stage. A stage's input is the ring in front of it.
+        """
+        raw, store = self.raw.stats(), self.store.stats()
+        return {'receiver': {'messages': raw['puts'], 'bytes': raw['bytes'], 'full_waits': raw['full_waits']},
+                'book': {'messages': raw['gets'], 'backlog': raw['depth'], 'full_waits': store['full_waits']},
+                'storage': {'messages': store['gets'], 'backlog': store['depth']}}
+
+    def throughput(self):
+        """
+        Messages per second of each stage since the previous call.
+        """
+        now, stats = time.time(), self.stats()
+        last_time, last_stats = self._last
+        self._last = (now, stats)
+        elapsed = (now - last_time) or 1e-9
+        return {stage: (stats[stage]['messages'] - last_stats[stage]['messages']) / elapsed for stage in stats}
+
+    def exit(self):
+        """
+        Stop receiving and let the other stages drain their rings. A process still
+        running after JOIN_TIMEOUT seconds is terminated.
+        """
+        self.stop.set()
+        for p in self.processes:
+            p.join(JOIN_TIMEOUT)
+            if p.is_alive():
+                self.logger.error('%s process did not stop, terminating it.' % p.name)
+                p.terminate()
+                p.join()
+        self._closing.set()
+        self._supervisor.join()
+        self.raw.close()
+        self.store.close()
+        self.logger.info('Pipeline stopped.')
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-run soak test of BitMEXWebsocket.
+
+Drives synthetic or replayed traffic through BitMEXWebsocket.process_message
+for hours, against a local Redis database and a storage sink that stands in
+for MongoDB, and samples over time:
+
+    traced_bytes : memory allocated by Python, from tracemalloc
+    rss_bytes    : current resident set size of the process, left out if it can't be read
+    table_rows   : rows in BitMEXWebsocket.data, all tables
+    queue_depth  : messages waiting in the storage queue
+    redis_keys   : keys in the Redis database
+
+A least-squares slope is fitted to each series after a warm-up period, and the
+run fails (exit code 1) if any slope exceeds its threshold per hour. The top
+allocation sites that grew are printed from tracemalloc snapshots.
+
+    python soak.py --hours 4 --rate 200
+    python soak.py --hours 1 --replay ../websocket.log --sink-delay 0.001
+
+The Redis database given by --redis-db is flushed at the start.
+
+@author: zhishe
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import datetime
+import argparse
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+
+import redis
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from bitmex_websocket import BitMEXWebsocket, EXCH
+from spill_queue import SpillQueue
+
+# Maximum growth per hour of each sampled series before the run fails.
+THRESHOLDS = {
+    'traced_bytes': 16 * 1024 * 1024,
+    'rss_bytes': 64 * 1024 * 1024,
+    'table_rows': 1000,
+    'queue_depth': 1000,
+    'redis_keys': 1000,
+}
+
+WARMUP = 0.1  # fraction of the run left out of the slope fit
+
+SYMBOL = 'XBTUSD'
+
+
+class SyntheticFeed:
+    """
+    Generates BitMEX websocket messages for one symbol: an orderBookL2 that keeps
+    about the same number of levels, trades, quotes and orders that get filled.
+    """
+
+    TICK = 0.5
+    INDEX = 88  # orderBookL2 ids are 100000000 * INDEX - price * 100
+
+    def __init__(self, levels=500, mid=10000.0, seed=0):
+        self.rng = random.Random(seed)
+        self.levels = levels
+        self.mid = mid
+        self.book = {}  # price : size
+        self.openOrders = []
+        self.nextOrder = 0
+
+    def __iter__(self):
+        yield self.message('instrument', 'partial', [{'symbol': SYMBOL, 'tickSize': self.TICK}], keys=['symbol'])
+        yield self.message('quote', 'partial', [self.quote()], keys=[])
+        yield self.message('trade', 'partial', [self.trade()], keys=[])
+        yield self.message('order', 'partial', [], keys=['orderID'])
+
+        for i in range(self.levels):
+            price = self.mid + (i - self.levels // 2) * self.TICK
+            self.book[price] = self.rng.randint(1, 10000)
+        yield self.message('orderBookL2', 'partial', [self.row(p, s) for p, s in self.book.items()],
+                           keys=['symbol', 'id', 'side'])
+
+        while True:
+            r = self.rng.random()
+            if r < 0.5:
+                price = self.rng.choice(list(self.book))
+                self.book[price] = self.rng.randint(1, 10000)
+                yield self.message('orderBookL2', 'update', [self.row(price, self.book[price])])
+            elif r < 0.65 and len(self.book) < self.levels * 1.2:
+                price = self.mid + self.rng.randint(-self.levels, self.levels) * self.TICK
+                if price not in self.book and price != self.mid:
+                    self.book[price] = self.rng.randint(1, 10000)
+                    yield self.message('orderBookL2', 'insert', [self.row(price, self.book[price])])
+            elif r < 0.8 and len(self.book) > self.levels * 0.8:
+                price = self.rng.choice(list(self.book))
+                row = self.row(price, self.book.pop(price))
+                del row['size'], row['price']
+                yield self.message('orderBookL2', 'delete', [row])
+            elif r < 0.9:
+                yield self.message('trade', 'insert', [self.trade()])
+            elif r < 0.95:
+                yield self.message('quote', 'insert', [self.quote()])
+            elif self.openOrders and self.rng.random() < 0.5:
+                orderID = self.openOrders.pop(0)
+                yield self.message('order', 'update', [{'orderID': orderID, 'leavesQty': 0}])
+            else:
+                orderID = 'soak-%d' % self.nextOrder
+                self.nextOrder += 1
+                self.openOrders.append(orderID)
+                yield self.message('order', 'insert', [{'orderID': orderID, 'clOrdID': orderID, 'leavesQty': 100}])
+
+    def row(self, price, size):
+        return {'symbol': SYMBOL, 'id': int(100000000 * self.INDEX - price * 100),
+                'side': 'Buy' if price < self.mid else 'Sell', 'size': size, 'price': price}
+
+    def quote(self):
+        return {'symbol': SYMBOL, 'bidSize': 100, 'bidPrice': self.mid - self.TICK,
+                'askPrice': self.mid + self.TICK, 'askSize': 100}
+
+    def trade(self):
+        timestamp = datetime.datetime.utcnow().isoformat(timespec='milliseconds') + 'Z'
+        return {'timestamp': timestamp, 'symbol': SYMBOL, 'side': self.rng.choice(['Buy', 'Sell']),
+                'size': self.rng.randint(1, 1000), 'price': self.mid}
+
+    @staticmethod
+    def message(table, action, data, keys=None):
+        message = {'table': table, 'action': action, 'data': data}
+        if keys is not None:
+            message['keys'] = keys
+        return json.dumps(message)
+
+
+def replay_feed(path):
+    """
+    The messages of a websocket.log recorded at DEBUG level, over and over.
+    """
+    messages = []
+    with open(path) as f:
+        for line in f:
+            i = line.find(' - DEBUG - {"table"')
+            if i >= 0:
+                messages.append(line[i + len(' - DEBUG - '):].strip())
+    if not messages:
+        raise ValueError('No messages found in %s' % path)
+    while True:
+        yield from messages
+
+
+def null_sink(queue, delay, counter):
+    """
+    Stands in for write_to_db: drains the storage queue, taking `delay` seconds per message.
+    """
+    while True:
+        timestamp, message = queue.get()
+        if message.get('action') == 'terminate':
+            break
+        counter[0] += 1
+        if delay:
+            time.sleep(delay)
+
+
+def rss_bytes():
+    """
+    The current resident set size of the process, or None if no source is available.
+    getrusage() is no use here: it gives the peak, in KB on Linux but bytes on macOS.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    try:
+        # KB on both Linux and macOS
+        return int(subprocess.check_output(['ps', '-o', 'rss=', '-p', str(os.getpid())])) * 1024
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def slope_per_hour(times, values):
+    n = len(times)
+    if n < 2:
+        return 0.0
+    mt = sum(times) / n
+    mv = sum(values) / n
+    var = sum((t - mt) ** 2 for t in times)
+    if not var:
+        return 0.0
+    return sum((t - mt) * (v - mv) for t, v in zip(times, values)) / var * 3600
+
+
+def run(hours, rate, sample_interval, redis_db, replay=None, sink_delay=0.0, levels=500):
+    red = redis.StrictRedis(charset='utf-8', decode_responses=True, db=redis_db)
+    red.flushdb()
+
+    queue = SpillQueue(tempfile.mkdtemp(prefix='soak-spool-'))
+    written = [0]
+    sink = threading.Thread(target=null_sink, args=(queue, sink_delay, written))
+    sink.start()
+
+    ws = BitMEXWebsocket('https://testnet.bitmex.com/api/v1', SYMBOL, red, db_queue=queue, connect=False)
+    feed = iter(replay_feed(replay) if replay else SyntheticFeed(levels))
+
+    tracemalloc.start()
+    samples = []
+    baseline = None
+    start = time.time()
+    end = start + hours * 3600
+    nextSample = start
+    sent = 0
+    try:
+        while time.time() < end:
+            ws.process_message(next(feed))
+            sent += 1
+            if rate:
+                delay = start + sent / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            now = time.time()
+            if now >= nextSample:
+                nextSample = now + sample_interval
+                sample = {'t': now - start,
+                          'traced_bytes': tracemalloc.get_traced_memory()[0],
+                          'rss_bytes': rss_bytes(),
+                          'table_rows': sum(len(t) for t in ws.data.values()),
+                          'queue_depth': len(queue),
+                          'redis_keys': red.dbsize()}
+                if sample['rss_bytes'] is None:
+                    del sample['rss_bytes']
+                samples.append(sample)
+                print('%8.0fs  sent %10d  stored %10d  %s' % (
+                    sample['t'], sent, written[0],
+                    '  '.join('%s %d' % (k, v) for k, v in sample.items() if k != 't')))
+                if baseline is None and now - start >= WARMUP * hours * 3600:
+                    baseline = tracemalloc.take_snapshot()
+    finally:
+        final = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        ws.exit()
+        sink.join()
+        queue.close()
+
+    # table sizes by table and log file sizes, for the report
+    print('\ntables: %s' % {t: len(rows) for t, rows in ws.data.items()})
+    for handler in ws.logger.handlers:
+        if hasattr(handler, 'baseFilename') and os.path.exists(handler.baseFilename):
+            print('log %s: %d bytes' % (handler.baseFilename, os.path.getsize(handler.baseFilename)))
+
+    if baseline is not None:
+        print('\ntop allocation growth since warm-up:')
+        for stat in final.compare_to(baseline, 'lineno')[:10]:
+            print('  %s' % stat)
+
+    kept = [s for s in samples if s['t'] >= WARMUP * hours * 3600]
+    failed = []
+    print('\ngrowth per hour after warm-up:')
+    for name, threshold in THRESHOLDS.items():
+        series = [s for s in kept if name in s]
+        if not series:
+            print('  %-12s %14s  (not sampled)' % (name, '-'))
+            continue
+        slope = slope_per_hour([s['t'] for s in series], [s[name] for s in series])
+        status = 'FAIL' if slope > threshold else 'ok'
+        if slope > threshold:
+            failed.append(name)
+        print('  %-12s %14.1f  (threshold %d)  %s' % (name, slope, threshold, status))
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soak test of the %s collector.' % EXCH)
+    parser.add_argument('--hours', type=float, default=1.0)
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 for as fast as possible')
+    parser.add_argument('--sample-interval', type=float, default=10, help='seconds')
+    parser.add_argument('--redis-db', type=int, default=15, help='flushed at the start')
+    parser.add_argument('--replay', help='websocket.log to replay instead of synthetic traffic')
+    parser.add_argument('--sink-delay', type=float, default=0.0, help='seconds the storage sink takes per message')
+    parser.add_argument('--levels', type=int, default=500, help='order book levels of the synthetic feed')
+    args = parser.parse_args()
+
+    ok = run(args.hours, args.rate, args.sample_interval, args.redis_db,
+             replay=args.replay, sink_delay=args.sink_delay, levels=args.levels)
+    sys.exit(0 if ok else 1)
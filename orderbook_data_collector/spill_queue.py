@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+@author: zhishe
+"""
+
+import os
+import json
+import threading
+from collections import deque
+from queue import Empty
+
+# Number of items kept in memory before spilling to disk.
+MEMORY_THRESHOLD = 10000
+
+# Number of items written into one segment file before a new one is started.
+SEGMENT_SIZE = 10000
+
+
+class SpillQueue:
+    """
+    A FIFO queue that holds up to `threshold` items in memory and appends
+    the overflow to segment files on local disk.
+
+    It is a drop-in replacement for queue.Queue as far as the websocket
+    thread and write_to_db are concerned: put() never blocks, get() blocks
+    until an item is available. Items must be JSON serializable; tuples
+    come back as tuples.
+
+    Items still on disk when the process exits are replayed on the next
+    start. The read position is saved by close(); after a crash the
+    partly consumed segment is replayed from its start, so delivery is
+    at-least-once.
+    """
+
+    def __init__(self, directory, threshold=MEMORY_THRESHOLD, segment_size=SEGMENT_SIZE):
+        """
+        directory : str
+            where the segment files are kept. One directory per queue.
+        threshold : int
+            max number of items held in memory.
+        segment_size : int
+            max number of items per segment file.
+        """
+        self.directory = directory
+        self.threshold = threshold
+        self.segment_size = segment_size
+
+        self._memory = deque()  # always older than anything on disk
+        self._cond = threading.Condition()
+
+        # segment numbers currently on disk, oldest first
+        self._segments = deque()
+        self._disk_count = 0
+
+        self._write_file = None
+        self._write_segment = None
+        self._write_count = 0
+
+        self._read_file = None
+        self._read_segment = None
+        self._read_count = 0
+        # lines of a segment consumed in a previous run, as (segment, count)
+        self._skip = (None, 0)
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._memory) + self._disk_count
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return len(self) == 0
+
+    def put(self, item):
+        with self._cond:
+            if self._closed:
+                # the reader is gone, e.g. a message still being processed when the writer
+                # stopped; it goes straight to disk for the next run
+                self._spill(item)
+                self._write_file.flush()
+            elif self._disk_count or len(self._memory) >= self.threshold:
+                self._spill(item)
+            else:
+                self._memory.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item. Blocks until one is available,
+        or raises queue.Empty after `timeout` seconds.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._memory or self._disk_count, timeout):
+                raise Empty
+            if self._memory:
+                return self._memory.popleft()
+            return self._unspill()
+
+    def unget(self, items):
+        """
+        Put items taken by get() back at the front of the queue, oldest first.
+        """
+        with self._cond:
+            self._memory.extendleft(reversed(items))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close the open segment files. Unconsumed items, including those
+        still in memory, remain on disk and the read position is saved for
+        the next run. Items put after close() are written to disk as well.
+        """
+        with self._cond:
+            self._closed = True
+            if self._memory:
+                # memory items are older than anything on disk, so they go
+                # into a segment in front of the others
+                segment = self._segments[0] - 1 if self._segments else 0
+                with open(self._path(segment), 'w') as f:
+                    for item in self._memory:
+                        f.write(json.dumps(item) + '\n')
+                self._segments.appendleft(segment)
+                self._memory.clear()
+            if self._write_file is not None:
+                self._write_file.close()
+                self._write_file = None
+            cursor = self._skip  # still pending if nothing was read since the last start
+            if self._read_file is not None:
+                self._read_file.close()
+                self._read_file = None
+                cursor = (self._read_segment, self._read_count)
+            if cursor[0] is not None:
+                with open(self._cursor_path(), 'w') as f:
+                    f.write('%d %d' % cursor)
+
+    #
+    # disk segments
+    #
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%d.seg' % segment)
+
+    def _cursor_path(self):
+        return os.path.join(self.directory, 'cursor')
+
+    def _recover(self):
+        """
+        Pick up segments left over from a previous run.
+        """
+        cursor_segment, consumed = None, 0
+        if os.path.exists(self._cursor_path()):
+            with open(self._cursor_path()) as f:
+                cursor_segment, consumed = map(int, f.read().split())
+            os.remove(self._cursor_path())
+
+        segments = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+        for segment in segments:
+            with open(self._path(segment)) as f:
+                count = sum(1 for line in f if line.endswith('\n'))
+            if segment == cursor_segment:
+                count -= consumed
+            if count > 0:
+                if segment == cursor_segment:
+                    self._skip = (segment, consumed)
+                self._segments.append(segment)
+                self._disk_count += count
+            else:
+                os.remove(self._path(segment))
+
+    def _spill(self, item):
+        if self._write_file is None or self._write_count >= self.segment_size:
+            if self._write_file is not None:
+                self._write_file.close()
+            self._write_segment = self._segments[-1] + 1 if self._segments else 0
+            self._segments.append(self._write_segment)
+            self._write_file = open(self._path(self._write_segment), 'a')
+            self._write_count = 0
+
+        self._write_file.write(json.dumps(item) + '\n')
+        self._write_count += 1
+        self._disk_count += 1
+
+    def _unspill(self):
+        while True:
+            if self._read_file is None:
+                self._read_segment = self._segments[0]
+                self._read_file = open(self._path(self._read_segment))
+                self._read_count = 0
+                if self._skip[0] == self._read_segment:
+                    for _ in range(self._skip[1]):
+                        self._read_file.readline()
+                        self._read_count += 1
+                    self._skip = (None, 0)
+
+            if self._read_segment == self._write_segment:
+                self._write_file.flush()  # reading the segment being written
+
+            line = self._read_file.readline()
+            if line.endswith('\n'):
+                self._read_count += 1
+                self._disk_count -= 1
+                if not self._disk_count:
+                    self._drop_read_segment()  # disk drained, go back to memory
+                item = json.loads(line)
+                return tuple(item) if isinstance(item, list) else item
+
+            # end of a finished segment (a truncated last line is left over from a crash)
+            self._drop_read_segment()
+
+    def _drop_read_segment(self):
+        self._read_file.close()
+        self._read_file = None
+        if self._read_segment == self._write_segment:
+            self._write_file.close()
+            self._write_file = None
+            self._write_segment = None
+        os.remove(self._path(self._read_segment))
+        self._segments.popleft()
+
+
+def main():
+    """
+    Restart checks: close the queue at various points of a run, reopen it and
+    check that the items come back in order, each one exactly once.
+
+        python spill_queue.py
+    """
+    import tempfile
+
+    def drain(queue):
+        items = []
+        while True:
+            try:
+                items.append(queue.get(timeout=0)[0])
+            except Empty:
+                return items
+
+    for n in range(30):
+        for consumed in range(n + 1):
+            directory = tempfile.mkdtemp(prefix='spill-')
+            queue = SpillQueue(directory, threshold=3, segment_size=4)
+            for i in range(n):
+                queue.put((i, {}))
+            got = [queue.get()[0] for _ in range(consumed)]
+            queue.close()
+
+            for _ in range(2):  # the second time without reading in between
+                queue = SpillQueue(directory, threshold=3, segment_size=4)
+                assert len(queue) == n - consumed, (n, consumed, len(queue))
+                queue.close()
+
+            queue = SpillQueue(directory, threshold=3, segment_size=4)
+            got += drain(queue)
+            queue.close()
+            queue.put((n, {}))  # after close(), kept for the next run
+
+            queue = SpillQueue(directory, threshold=3, segment_size=4)
+            got += drain(queue)
+            queue.close()
+            assert got == list(range(n + 1)), (n, consumed, got)
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()